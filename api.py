@@ -0,0 +1,52 @@
+import json
+from datetime import datetime
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+PRODUCT_FIELDS = ['id', 'title', 'desc', 'desc_opt', 'date', 'price', 'categories', 'primary_image', 'author',
+                  'availability', 'assignment', 'material', 'material_opt', 'color', 'color_opt', 'size',
+                  'weight', 'guarantee']
+# 'images' is not a column; the detail endpoint fills it from ProductImage.
+DETAIL_FIELDS = PRODUCT_FIELDS + ['images']
+CARD_FIELDS = ['id', 'title', 'desc_opt', 'price', 'primary_image']
+DEFAULT_LIMIT = 24
+MAX_LIMIT = 100
+
+
+def parse_fields(value, default=CARD_FIELDS, allowed=PRODUCT_FIELDS):
+    """?fields=id,title,price -> the requested known fields, in the order of allowed."""
+    if not value:
+        return list(default)
+    requested = set(value.split(','))
+    return [field for field in allowed if field in requested] or list(default)
+
+
+def parse_limit(value):
+    try:
+        return max(1, min(int(value), MAX_LIMIT))
+    except (TypeError, ValueError):
+        return DEFAULT_LIMIT
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default)
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':'), default=_default)
+
+
+def serialize(rows, fields):
+    return [{field: getattr(row, field) for field in fields} for row in rows]
+
+
+def json_response(payload, status=200):
+    return Response(dumps(payload), status=status, mimetype='application/json')
@@ -1,25 +1,63 @@
-from flask import Flask, render_template, request, make_response, redirect, send_from_directory, url_for
-from flask_paginate import Pagination, get_page_parameter
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, render_template, request, make_response, redirect, url_for, Response, stream_with_context
+from flask_sqlalchemy import SQLAlchemy, Pagination as SearchPagination
 from sqlalchemy.sql.expression import func
+from sqlalchemy.exc import DataError, IntegrityError
+import click
 import os
-import random
-from pathlib import Path
-from werkzeug.utils import secure_filename
-from datetime import datetime
+import json
+from datetime import datetime, timedelta
 from authorization import *
 from config import *
+import search as search_index
+import migrations
+import catalog
+import sales
+import listing
+import bulk
+from images import ImagePipeline
+from assets import AssetManifest
+import database
+from orders_queue import OrderQueue, QueueFull
+import uuid
+import api
+from cache import PageCache
+from metrics import Metrics
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///shop.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = database.database_uri(DATABASE_URL)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = database.engine_options(app.config['SQLALCHEMY_DATABASE_URI'],
+                                                                  pool_size=DB_POOL_SIZE,
+                                                                  max_overflow=DB_MAX_OVERFLOW,
+                                                                  pool_recycle=DB_POOL_RECYCLE,
+                                                                  pool_pre_ping=DB_POOL_PRE_PING)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+app.config['CACHE_TYPE'] = CACHE_TYPE
+app.config['CACHE_MAX_SIZE'] = CACHE_MAX_SIZE
+app.config['CACHE_TTL'] = CACHE_TTL
+app.config['CACHE_REDIS_URL'] = CACHE_REDIS_URL
+app.config['ASSETS_MAX_AGE'] = ASSETS_MAX_AGE
+app.config['ASSETS_PRECOMPRESS'] = ASSETS_PRECOMPRESS
+app.config['METRICS_SLOW_QUERY'] = METRICS_SLOW_QUERY
+app.config['METRICS_N_PLUS_ONE'] = METRICS_N_PLUS_ONE
+app.config['METRICS_SERVER_TIMING'] = METRICS_SERVER_TIMING
 
 db = SQLAlchemy(app)
+database.configure_sqlite(db.engine, busy_timeout=SQLITE_BUSY_TIMEOUT, mmap_size=SQLITE_MMAP_SIZE)
+metrics = Metrics(app, db.engine)
 
 
 class Product(db.Model):
+    __table_args__ = (
+        db.Index('ix_product_visibility_categories_date', 'visibility', 'categories', 'date'),
+        db.Index('ix_product_visibility_author_date', 'visibility', 'author', 'date'),
+        db.Index('ix_product_date', 'date'),
+        db.Index('ix_product_visibility_author_id_date', 'visibility', 'author_id', 'date'),
+        db.Index('ix_product_material_id', 'material_id'),
+        db.Index('ix_product_color_id', 'color_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(80), default='Product №' + id)
     desc = db.Column(db.Text, default='There is no description')
@@ -39,12 +77,51 @@ class Product(db.Model):
     size = db.Column(db.String(250), nullable=True)
     weight = db.Column(db.String(250), nullable=True)
     guarantee = db.Column(db.String(250), nullable=True)
+    primary_image = db.Column(db.String(250), nullable=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('author.id'), nullable=True)
+    material_id = db.Column(db.Integer, db.ForeignKey('material.id'), nullable=True)
+    color_id = db.Column(db.Integer, db.ForeignKey('color.id'), nullable=True)
+
+    images = db.relationship('ProductImage', order_by='ProductImage.position', cascade='all, delete-orphan')
 
     def __repr__(self):
         return 'Product %r' % self.id
 
 
+class ProductImage(db.Model):
+    __table_args__ = (
+        db.Index('ix_product_image_product_id_position', 'product_id', 'position'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    path = db.Column(db.String(250), nullable=False)
+    position = db.Column(db.Integer, default=0)
+    is_primary = db.Column(db.Boolean, default=False)
+
+
+class Author(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(250), unique=True, nullable=False)
+
+
+class Material(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(250), unique=True, nullable=False)
+
+
+class Color(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(250), unique=True, nullable=False)
+
+
 class Order(db.Model):
+    __table_args__ = (
+        db.Index('ix_order_product_id', 'product_id'),
+        db.Index('ix_order_date', 'date'),
+        db.Index('ix_order_idempotency_key', 'idempotency_key', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     product_id = db.Column(db.Integer)
     name = db.Column(db.String(25))
@@ -55,95 +132,226 @@ class Order(db.Model):
     comment = db.Column(db.Text, nullable=True)
     processed = db.Column(db.Boolean, default=False)
     date = db.Column(db.DateTime, default=datetime.utcnow)
+    idempotency_key = db.Column(db.String(64), nullable=True)
+
+
+class Category(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(250), unique=True, nullable=False)
+    image = db.Column(db.String(250), nullable=True)
+    product_count = db.Column(db.Integer, default=0)
+
+    def __repr__(self):
+        return 'Category %r' % self.name
+
+
+class ProductSales(db.Model):
+    __table_args__ = (
+        db.Index('ix_product_sales_month_count', 'month', 'count'),
+    )
+
+    product_id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.String(7), primary_key=True)
+    count = db.Column(db.Integer, default=0)
+
+
+class CatalogVersion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, default=0)
+    updated = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+def lookup_id(model, name):
+    """Id of the Author/Material/Color row with this name, created on first use."""
+    if not name:
+        return None
+    row = model.query.filter(model.name == name).first()
+    if not row:
+        row = model(name=name)
+        db.session.add(row)
+        db.session.flush()
+    return row.id
+
+
+def lookup_ids(model, names):
+    """lookup_id for many names at once: {name: id}, creating the missing rows."""
+    names = {name for name in names if name}
+    if not names:
+        return {}
+    found = dict(db.session.query(model.name, model.id).filter(model.name.in_(names)))
+    missing = names - set(found)
+    if missing:
+        db.session.bulk_insert_mappings(model, [{'name': name} for name in missing])
+        found.update(db.session.query(model.name, model.id).filter(model.name.in_(missing)))
+    return found
+
+
+def normalize_product(product):
+    """Mirror the free-text image, author, material and color fields into their tables."""
+    paths = (product.image or '').split()
+    product.images = [ProductImage(path=path, position=position, is_primary=position == 0)
+                      for position, path in enumerate(paths)]
+    product.primary_image = paths[0] if paths else None
+    product.author_id = lookup_id(Author, product.author)
+    product.material_id = lookup_id(Material, product.material)
+    product.color_id = lookup_id(Color, product.color)
+
+
+# Only product writes bump the version. Orders leave it alone: they would serialize every buy() on this
+# one row and flush every cached page; the popular-products fragment follows sales by expiring instead.
+def catalog_version():
+    row = CatalogVersion.query.get(1)
+    if not row:
+        return 0, None
+    return row.version, row.updated
+
+
+def bump_catalog_version():
+    """Invalidate cached pages; call inside the transaction that changes the catalog."""
+    updated = CatalogVersion.query.filter(CatalogVersion.id == 1)\
+        .update({CatalogVersion.version: CatalogVersion.version + 1,
+                 CatalogVersion.updated: datetime.utcnow()}, synchronize_session=False)
+    if not updated:
+        db.session.add(CatalogVersion(id=1, version=1, updated=datetime.utcnow()))
+
+
+if DB_AUTO_MIGRATE:
+    migrations.upgrade(db)
+page_cache = PageCache(app, catalog_version)
+product_sampler = catalog.ProductSampler()
+image_pipeline = ImagePipeline(app.static_folder)
+app.jinja_env.globals['picture'] = image_pipeline.picture
+asset_manifest = AssetManifest(app)
+
+
+@app.cli.command('db-upgrade')
+def db_upgrade():
+    """Create missing tables and apply pending migrations."""
+    migrations.upgrade(db)
+
+
+@app.cli.command('db-status')
+def db_status():
+    """List migrations and whether this database has applied them."""
+    for name, applied in migrations.status(db):
+        print('%s %s' % ('[x]' if applied else '[ ]', name))
+
+
+@app.cli.command('rebuild-search')
+def rebuild_search():
+    """Rebuild the full-text search index from the product table."""
+    with db.engine.begin() as conn:
+        search_index.rebuild(conn)
+
+
+@app.cli.command('rebuild-categories')
+def rebuild_categories():
+    """Rebuild the category table from the product table."""
+    with db.engine.begin() as conn:
+        catalog.rebuild_categories(conn)
+
+
+@app.cli.command('rebuild-sales')
+def rebuild_sales():
+    """Recompute the monthly sales counters from the order table."""
+    with db.engine.begin() as conn:
+        sales.rebuild_sales(conn)
+
+
+@app.cli.command('import-products')
+@click.argument('path')
+@click.option('--format', type=click.Choice(['csv', 'jsonl']), default=None)
+def import_products_command(path, format):
+    """Import products from a CSV or JSONL file, reporting progress and rejected rows."""
+    with open(path, 'rb') as f:
+        for report in import_products(f, bulk.import_format(path, format)):
+            print(json.dumps(report, ensure_ascii=False))
+
+
+@app.cli.command('compress-assets')
+def compress_assets():
+    """Write gzip/brotli copies of the text assets under static/."""
+    asset_manifest.compress_all()
+
+
+@app.cli.command('build-image-variants')
+def build_image_variants():
+    """Render the resized variants of every product image that lacks them."""
+    for product in Product.query.all():
+        for path in (product.image or '').split():
+            try:
+                image_pipeline.make_variants(path)
+            except OSError as e:
+                print('%s: %s' % (path, e))
 
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
 @app.route('/')
 def index():
-    products = Product.query.filter(Product.visibility == True).filter(Product.categories != "").order_by(
-        Product.date).all()
-
+    # Left unexecuted: index.html only runs these when its cached fragment is stale.
+    popular_month = sales.month_key(datetime.utcnow())
     four_popular_products = db.session.query(Product) \
-        .outerjoin(Order, Product.id == Order.product_id) \
-        .filter(Order.date >= datetime(datetime.today().year, datetime.today().month, day=1)) \
+        .join(ProductSales, Product.id == ProductSales.product_id) \
+        .filter(ProductSales.month == popular_month) \
         .filter(Product.visibility == True) \
-        .group_by(Product.id) \
-        .order_by(db.func.count(Order.product_id).desc()) \
-        .limit(4).all()
-
-    four_products = Product.query.filter(Product.visibility == True).order_by(func.random()).limit(4).all()
-
-    four_new_products = Product.query.filter(Product.visibility == True).order_by(Product.date.desc()).limit(4).all()
+        .order_by(ProductSales.count.desc()) \
+        .limit(4)
 
-    categories = []
-    cat_images = []
-    for product in products:
-        categories.append(product.categories)
-        cat_images.append((product.image.split(' '))[0])
+    version, _ = page_cache.current_version()
+    random_ids = product_sampler.sample(db.session, version, 4)
+    found = {p.id: p for p in Product.query.filter(Product.id.in_(random_ids)).all()} if random_ids else {}
+    four_products = [found[i] for i in random_ids if i in found]
 
-    cat_img = dict(zip(categories, cat_images))
-    keys = list(set(cat_img.keys()))
-    random.shuffle(keys)
-    cat_img_shuffled = dict()
-    for key in keys:
-        cat_img_shuffled.update({key: cat_img[key]})
+    four_new_products = Product.query.filter(Product.visibility == True).order_by(Product.date.desc()).limit(4)
 
-    categories = []
-    cat_images = []
-    for c, i in cat_img_shuffled.items():
-        categories.append(c)
-        cat_images.append(i)
+    categories = Category.query.order_by(func.random()).limit(5).all()
 
     return render_template("index.html",
                            four_popular_products=four_popular_products,
+                           popular_month=popular_month,
                            four_products=four_products,
                            four_new_products=four_new_products,
-                           categories=categories[:5],
-                           cat_images=cat_images[:5])
+                           categories=[c.name for c in categories],
+                           cat_images=[c.image for c in categories])
 
 
-@app.route('/search/', methods=['POST'])
+@app.route('/search/', methods=['POST', 'GET'])
 def search():
-    if request.method == "POST":
-        products = Product.query.order_by(Product.date).all()
-        search = request.form['search'].lower()
-        sorted = []
-        for p in products:
-            if (search in p.title.lower() \
-                or search in p.desc.lower() \
-                or search in p.desc_opt.lower() \
-                or search in p.author.lower() \
-                or search in p.categories.lower() \
-                or search in p.material.lower() \
-                or search in p.material_opt.lower() \
-                or search in p.color.lower() \
-                or search in p.color_opt.lower()) \
-                    and p.visibility:
-                sorted.append(p)
-        sorted = list(set(sorted))
-        if not sorted:
-            return render_template("not_found.html")
-    return render_template("search.html", sorted=sorted, search=search)
+    search = request.values.get('search', '').strip()
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = 12
+
+    ids, total = search_index.search_products(db.session, search, page=page, per_page=per_page)
+    if not ids:
+        return render_template("not_found.html")
+
+    found = {p.id: p for p in Product.query.filter(Product.id.in_(ids)).all()}
+    products = SearchPagination(None, page, per_page, total, [found[i] for i in ids if i in found])
+    return render_template("search.html", products=products, search=search)
 
 
 @app.route('/product/<int:id>')
+@page_cache.cached
 def product(id, success=0):
     product = Product.query.get(id)
     if not product or not product.visibility:
         return render_template("not_found.html")
 
     four_products = Product.query\
+        .filter(Product.visibility == True)\
         .filter(Product.categories == product.categories)\
         .filter(Product.title != product.title)\
+        .order_by(Product.date)\
         .limit(4).all()
 
     return render_template("product.html", product=product, success=success, four_products=four_products)
 
 
 @app.route('/all_products/<int:page_num>')
+@page_cache.cached
 def all_products(page_num=1):
     products = Product.query.filter(Product.visibility == True).order_by(Product.date).paginate(per_page=12,
                                                                                                 page=page_num,
@@ -153,55 +361,330 @@ def all_products(page_num=1):
 
 
 @app.route('/categories/')
+@page_cache.cached
 def categories():
-    products = Product.query.filter(Product.visibility == True).filter(Product.categories != "").all()
-    categories = []
-    cat_images = []
-    for product in products:
-        categories.append(product.categories)
-        cat_images.append(product.image)
-
-    cat_img = dict(zip(categories, cat_images))
-
-    categories = []
-    cat_images = []
-    for c, i in cat_img.items():
-        categories.append(c)
-        cat_images.append((i.split(' '))[0])
-
-    return render_template("categories.html", categories=categories, cat_images=cat_images)
-
-
-@app.route('/category/<category>')
-def category_product(category):
-    products = Product.query.all()
-    sorted = []
-    for product in products:
-        if category == product.categories and product.visibility:
-            sorted.append(product)
-    if not sorted:
+    categories = Category.query.order_by(Category.name).all()
+    return render_template("categories.html",
+                           categories=[c.name for c in categories],
+                           cat_images=[c.image for c in categories])
+
+
+@app.route('/category/<category>', defaults={'page_num': 1})
+@app.route('/category/<category>/<int:page_num>')
+@page_cache.cached
+def category_product(category, page_num):
+    products = Product.query.filter(Product.visibility == True).filter(Product.categories == category)\
+        .order_by(Product.date).paginate(per_page=12, page=page_num, error_out=False)
+    if not products.items:
         return render_template("not_found.html")
-    return render_template("category.html", sorted=sorted)
+    return render_template("category.html", products=products, category=category)
 
 
-@app.route('/author/<author>')
-def author_product(author):
-    products = Product.query.all()
-    sorted = []
-    for product in products:
-        if author == product.author and product.visibility:
-            sorted.append(product)
-    if not sorted:
+@app.route('/author/<author>', defaults={'page_num': 1})
+@app.route('/author/<author>/<int:page_num>')
+@page_cache.cached
+def author_product(author, page_num):
+    products = Product.query.join(Author, Product.author_id == Author.id)\
+        .filter(Product.visibility == True).filter(Author.name == author)\
+        .order_by(Product.date).paginate(per_page=12, page=page_num, error_out=False)
+    if not products.items:
         return render_template("not_found.html")
-    return render_template("author.html", sorted=sorted)
+    return render_template("author.html", products=products, author=author)
+
+
+def api_product_query(fields):
+    """Only the requested columns (plus the date/id seek key), as plain rows rather than ORM objects."""
+    columns = [getattr(Product, field) for field in dict.fromkeys(fields + ['id', 'date']) if field != 'images']
+    return db.session.query(*columns).filter(Product.visibility == True)
+
+
+def api_product_list(query, fields):
+    rows, next_cursor = listing.keyset_page(query, Product,
+                                            cursor=listing.parse_cursor(request.args.get('after')),
+                                            descending=request.args.get('sort') == 'desc',
+                                            per_page=api.parse_limit(request.args.get('limit')))
+    return api.json_response({'items': api.serialize(rows, fields), 'next': next_cursor})
+
+
+@app.route('/api/v1/products')
+@page_cache.cached_json
+def api_products():
+    fields = api.parse_fields(request.args.get('fields'))
+    return api_product_list(api_product_query(fields), fields)
+
+
+@app.route('/api/v1/products/<int:id>')
+@page_cache.cached_json
+def api_product(id):
+    fields = api.parse_fields(request.args.get('fields'), default=api.DETAIL_FIELDS, allowed=api.DETAIL_FIELDS)
+    row = api_product_query(fields).filter(Product.id == id).first()
+    if not row:
+        return api.json_response({'error': 'Not found'}, 404)
+    item = api.serialize([row], [field for field in fields if field != 'images'])[0]
+    if 'images' in fields:
+        item['images'] = [path for path, in db.session.query(ProductImage.path)
+                          .filter(ProductImage.product_id == id).order_by(ProductImage.position)]
+    return api.json_response(item)
+
+
+@app.route('/api/v1/categories/<category>/products')
+@page_cache.cached_json
+def api_category_products(category):
+    fields = api.parse_fields(request.args.get('fields'))
+    return api_product_list(api_product_query(fields).filter(Product.categories == category), fields)
+
+
+@app.route('/api/v1/authors/<author>/products')
+@page_cache.cached_json
+def api_author_products(author):
+    fields = api.parse_fields(request.args.get('fields'))
+    query = api_product_query(fields).join(Author, Product.author_id == Author.id).filter(Author.name == author)
+    return api_product_list(query, fields)
+
+
+@app.route('/api/v1/search')
+@page_cache.cached_json
+def api_search():
+    fields = api.parse_fields(request.args.get('fields'))
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = api.parse_limit(request.args.get('limit'))
+    ids, total = search_index.search_products(db.session, request.args.get('q', ''), page=page, per_page=per_page)
+    found = {row.id: row for row in api_product_query(fields).filter(Product.id.in_(ids))} if ids else {}
+    return api.json_response({'items': api.serialize([found[i] for i in ids if i in found], fields),
+                              'page': page,
+                              'total': total})
+
+
+def admin_products_query():
+    query = Product.query
+    visibility = request.args.get('visibility', '')
+    if visibility:
+        query = query.filter(Product.visibility == (visibility == '1'))
+    if request.args.get('category'):
+        query = query.filter(Product.categories == request.args['category'])
+    if request.args.get('author'):
+        query = query.filter(Product.author == request.args['author'])
+    return query
+
+
+def admin_orders_query():
+    query = Order.query
+    processed = request.args.get('processed', '')
+    if processed:
+        query = query.filter(Order.processed == (processed == '1'))
+    if request.args.get('product_id', type=int):
+        query = query.filter(Order.product_id == request.args.get('product_id', type=int))
+    date_from = listing.parse_date(request.args.get('date_from'))
+    if date_from:
+        query = query.filter(Order.date >= date_from)
+    date_to = listing.parse_date(request.args.get('date_to'))
+    if date_to:
+        query = query.filter(Order.date < date_to + timedelta(days=1))
+    return query
+
+
+def export_response(query, model, name):
+    format = request.args.get('format') if request.args.get('format') in ('json', 'jsonl') else 'csv'
+    columns = [column.key for column in model.__table__.columns]
+    mimetype = {'json': 'application/json', 'jsonl': 'application/x-ndjson', 'csv': 'text/csv'}[format]
+    return Response(stream_with_context(listing.export_rows(query.order_by(model.date, model.id), columns, format)),
+                    mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=%s.%s' % (name, format)})
+
+
+@app.route('/metrics')
+@auth_required
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/admin')
 @auth_required
 def admin():
-    products = Product.query.order_by(Product.date).all()
-    orders = Order.query.order_by(Order.date).all()
-    return render_template("admin.html", products=products, orders=orders)
+    descending = request.args.get('sort') == 'desc'
+    products, next_cursor = listing.keyset_page(admin_products_query(), Product,
+                                                cursor=listing.parse_cursor(request.args.get('after')),
+                                                descending=descending)
+    return render_template("admin.html", products=products, next_cursor=next_cursor, args=request.args)
+
+
+@app.route('/admin/orders')
+@auth_required
+def admin_orders():
+    descending = request.args.get('sort') == 'desc'
+    orders, next_cursor = listing.keyset_page(admin_orders_query(), Order,
+                                              cursor=listing.parse_cursor(request.args.get('after')),
+                                              descending=descending)
+    return render_template("admin_orders.html", orders=orders, next_cursor=next_cursor, args=request.args)
+
+
+@app.route('/admin/export')
+@auth_required
+def admin_export():
+    return export_response(admin_products_query(), Product, 'products')
+
+
+@app.route('/admin/orders/export')
+@auth_required
+def admin_orders_export():
+    return export_response(admin_orders_query(), Order, 'orders')
+
+
+def write_import_batch(batch):
+    """Upsert (line, row, values) import entries in one transaction, keeping the side tables create()/edit() keep.
+
+    Returns (rows written, [(line, row, error)] for rows rejected against the database).
+    """
+    # First statement of the transaction: on SQLite this takes the write lock reserve_ids relies on.
+    bump_catalog_version()
+
+    explicit, created, origin = {}, [], {}
+    for number, row, values in batch:
+        values = dict(values)
+        if 'image' in values:
+            paths = (values['image'] or '').split()
+            values['primary_image'] = paths[0] if paths else None
+        if values.get('id') is None:
+            values.pop('id', None)
+            created.append(values)
+        else:
+            # A later row for the same id wins.
+            explicit.setdefault(values['id'], {}).update(values)
+            origin[values['id']] = number, row
+
+    existing = dict(db.session.query(Product.id, Product.categories).filter(Product.id.in_(explicit))) \
+        if explicit else {}
+    updates = [values for id, values in explicit.items() if id in existing]
+    inserts, rejected = [], []
+    for id, values in explicit.items():
+        if id in existing:
+            continue
+        if values.get('title'):
+            inserts.append(values)
+        else:
+            rejected.append(origin[id] + ('title: required for new products',))
+    rows = updates + inserts + created
+    for model, column, id_column in ((Author, 'author', 'author_id'),
+                                     (Material, 'material', 'material_id'),
+                                     (Color, 'color', 'color_id')):
+        ids = lookup_ids(model, [values.get(column) for values in rows])
+        for values in rows:
+            if column in values:
+                values[id_column] = ids.get(values[column])
+
+    db.session.bulk_update_mappings(Product, updates)
+    if inserts:
+        db.session.bulk_insert_mappings(Product, inserts)
+        database.sync_sequence(db.session, 'product')
+    # New products get their ids up front, so they go in as one executemany like the rest.
+    for values, id in zip(created, database.reserve_ids(db.session, 'product', len(created))):
+        values['id'] = id
+    db.session.bulk_insert_mappings(Product, created)
+
+    with_images = [values for values in rows if 'image' in values]
+    if with_images:
+        ProductImage.query.filter(ProductImage.product_id.in_([values['id'] for values in with_images]))\
+            .delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(ProductImage, [
+            {'product_id': values['id'], 'path': path, 'position': position, 'is_primary': position == 0}
+            for values in with_images for position, path in enumerate((values['image'] or '').split())])
+
+    search_index.reindex_products(db.session, [values['id'] for values in rows])
+    for name in set(existing.values()) | {values.get('categories') for values in rows}:
+        catalog.refresh_category(db.session, name)
+    db.session.commit()
+    return len(rows), rejected
+
+
+def import_products(stream, format='csv', batch_size=IMPORT_BATCH_SIZE):
+    """Import products from a CSV/JSONL stream batch by batch.
+
+    Yields a report for every rejected row, one per batch and a final total. A batch the
+    database refuses is retried row by row, so one bad row only costs itself.
+    """
+    imported = rejected = 0
+    batch = []
+
+    def flush():
+        try:
+            return write_import_batch(batch)
+        except Exception:
+            db.session.rollback()
+        count, failed = 0, []
+        for entry in batch:
+            try:
+                written, refused = write_import_batch([entry])
+            except Exception as e:
+                db.session.rollback()
+                written, refused = 0, [(entry[0], entry[1], str(getattr(e, 'orig', e)).strip())]
+            count += written
+            failed += refused
+        return count, failed
+
+    def report():
+        count, failed = flush()
+        for number, row, error in failed:
+            yield {'line': number, 'error': error, 'row': row}
+        yield {'lines': [batch[0][0], batch[-1][0]], 'imported': count, 'rejected': len(failed)}
+        return count, len(failed)
+
+    for number, row, error in bulk.read_rows(stream, format):
+        values = None
+        if not error:
+            values, error = bulk.validate(row)
+        if error:
+            rejected += 1
+            yield {'line': number, 'error': error, 'row': row}
+            continue
+        batch.append((number, row, values))
+        if len(batch) >= batch_size:
+            count, refused = yield from report()
+            imported, rejected = imported + count, rejected + refused
+            batch = []
+    if batch:
+        count, refused = yield from report()
+        imported, rejected = imported + count, rejected + refused
+    yield {'done': True, 'imported': imported, 'rejected': rejected}
+
+
+@app.route('/admin/import', methods=['POST', 'GET'])
+@auth_required
+def admin_import():
+    if request.method == 'GET':
+        return render_template('admin_import.html')
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return render_template('admin_import.html', error='Choose a CSV or JSONL file')
+    format = bulk.import_format(upload.filename, request.form.get('format'))
+    reports = import_products(upload.stream, format)
+    return Response(stream_with_context(json.dumps(report, ensure_ascii=False) + '\n' for report in reports),
+                    mimetype='application/x-ndjson')
+
+
+@app.route('/admin/products/batch', methods=['POST'])
+@auth_required
+def products_batch():
+    ids = bulk.parse_ids(request.form.getlist('ids'))
+    action = request.form.get('action')
+    if not ids or action not in ('hide', 'show', 'delete'):
+        return redirect('/admin')
+
+    categories = [name for name, in db.session.query(Product.categories).filter(Product.id.in_(ids)).distinct()]
+    try:
+        if action == 'delete':
+            search_index.remove_products(db.session, ids)
+            ProductImage.query.filter(ProductImage.product_id.in_(ids)).delete(synchronize_session=False)
+            Product.query.filter(Product.id.in_(ids)).delete(synchronize_session=False)
+        else:
+            Product.query.filter(Product.id.in_(ids))\
+                .update({Product.visibility: action == 'show'}, synchronize_session=False)
+        for name in categories:
+            catalog.refresh_category(db.session, name)
+        bump_catalog_version()
+        db.session.commit()
+        return redirect('/admin')
+    except:
+        return "ERROR"
 
 
 @app.route('/create', methods=['POST', 'GET'])
@@ -230,10 +713,7 @@ def create():
 
         for image in images:
             if image and allowed_file(image.filename):
-                filename = secure_filename(image.filename)
-                image.save(os.path.join(os.path.abspath(os.curdir), 'static\\images\\dest\\photo', filename))
-                files += 'images/dest/photo/' + str(filename) + ' '
-                print(filename)
+                files += image_pipeline.save_upload(image) + ' '
 
         product = Product(title=title,
                           desc=desc,
@@ -254,7 +734,12 @@ def create():
                           guarantee=guarantee)
 
         try:
+            normalize_product(product)
             db.session.add(product)
+            db.session.flush()
+            search_index.index_product(db.session, product)
+            catalog.refresh_category(db.session, product.categories)
+            bump_catalog_version()
             db.session.commit()
             return redirect('/admin')
         except:
@@ -268,6 +753,7 @@ def create():
 def edit(id):
     product = Product.query.get(id)
     if request.method == "POST":
+        old_category = product.categories
         product.title = request.form['title']
         product.desc = request.form['desc']
         product.desc_opt = request.form['desc_opt']
@@ -290,14 +776,17 @@ def edit(id):
 
         for image in images:
             if image and allowed_file(image.filename):
-                filename = secure_filename(image.filename)
-                image.save(os.path.join(os.path.abspath(os.curdir), 'static\\images\\dest\\photo', filename))
-                files += 'images/dest/photo/' + str(filename) + ' '
-                print(filename)
+                files += image_pipeline.save_upload(image) + ' '
 
         product.image = files
 
         try:
+            normalize_product(product)
+            db.session.flush()
+            search_index.index_product(db.session, product)
+            catalog.refresh_category(db.session, old_category)
+            catalog.refresh_category(db.session, product.categories)
+            bump_catalog_version()
             db.session.commit()
             return redirect('/admin')
         except:
@@ -311,7 +800,11 @@ def edit(id):
 def delete(id):
     product = Product.query.get_or_404(id)
     try:
+        search_index.remove_product(db.session, product.id)
         db.session.delete(product)
+        db.session.flush()
+        catalog.refresh_category(db.session, product.categories)
+        bump_catalog_version()
         db.session.commit()
         return redirect('/admin')
     except:
@@ -320,11 +813,11 @@ def delete(id):
 
 @app.route('/images/<filename>')
 def uploaded_file(filename):
-    return send_from_directory('/images/', filename)
+    return redirect(url_for('static', filename='images/dest/photo/' + filename), code=301)
 
 
-@app.route('/buy/<int:product_id>', methods=['POST'])
-def buy(product_id):
+def order_form(product_id):
+    """The order fields from the buy form, or None when they do not validate."""
     name = request.form['name']
     phone = request.form['phone']
     address = request.form['address']
@@ -333,23 +826,84 @@ def buy(product_id):
     comment = request.form['comment']
 
     if name and phone and address:
-        if len(name) <= 30 and \
+        # Within the Order column sizes; PostgreSQL rejects anything longer.
+        if len(name) <= 25 and \
+                len(phone) <= 15 and \
                 len(address) <= 30 and \
                 len(post_index) <= 6 and \
                 len(email) <= 25:
-            order = Order(product_id=product_id,
-                          name=name,
-                          phone=phone,
-                          address=address,
-                          email=email,
-                          post_index=post_index,
-                          comment=comment)
+            return dict(product_id=product_id,
+                        name=name,
+                        phone=phone,
+                        address=address,
+                        email=email,
+                        post_index=post_index,
+                        comment=comment,
+                        idempotency_key=request.form.get('idempotency_key') or uuid.uuid4().hex)
+    return None
+
+
+def write_order_batch(entries):
+    """Commit a group of queued orders in one transaction, skipping keys that are already stored."""
+    with app.app_context():
+        try:
+            keys = [entry['idempotency_key'] for entry in entries]
+            stored = {key for key, in db.session.query(Order.idempotency_key)
+                      .filter(Order.idempotency_key.in_(keys))}
+            for entry in entries:
+                if entry['idempotency_key'] in stored:
+                    continue
+                stored.add(entry['idempotency_key'])
+                order = Order(date=datetime.fromisoformat(entry['date']),
+                              **{k: v for k, v in entry.items() if k != 'date'})
+                db.session.add(order)
+                sales.record_sale(db.session, order.product_id, order.date)
+            db.session.commit()
+        finally:
+            db.session.remove()
+
+
+order_queue = None
+if ORDER_INTAKE == 'queued':
+    order_queue = OrderQueue(os.path.join(app.root_path, ORDER_JOURNAL_DIR), write_order_batch,
+                             max_pending=ORDER_QUEUE_MAX_PENDING,
+                             batch_size=ORDER_QUEUE_BATCH_SIZE,
+                             interval=ORDER_QUEUE_INTERVAL,
+                             # The order itself is bad (too long, malformed); retrying will not help.
+                             permanent_errors=(IntegrityError, DataError, ValueError, TypeError, KeyError))
+    order_queue.start()
+
 
+@app.route('/buy/<int:product_id>', methods=['POST'])
+def buy(product_id):
+    fields = order_form(product_id)
+    if not fields:
+        return product(product_id, success=2)
+
+    if order_queue:
+        fields['date'] = datetime.utcnow().isoformat()
+        try:
+            order_queue.enqueue(fields)
+        except QueueFull:
+            return make_response(product(product_id, success=2), 503, {'Retry-After': '5'})
+        return product(product_id, success=1)
+
+    if Order.query.filter(Order.idempotency_key == fields['idempotency_key']).first():
+        return product(product_id, success=1)
+
+    order = Order(**fields)
     try:
         db.session.add(order)
+        db.session.flush()
+        sales.record_sale(db.session, order.product_id, order.date)
         db.session.commit()
         return product(product_id, success=1)
+    except IntegrityError:
+        # The same key was submitted twice at once and the other request stored the order.
+        db.session.rollback()
+        return product(product_id, success=1)
     except:
+        db.session.rollback()
         return product(product_id, success=2)
 
 
@@ -362,7 +916,7 @@ def order_process(id):
 
     try:
         db.session.commit()
-        return redirect('/admin')
+        return redirect('/admin/orders')
     except:
         return "ERROR"
 
@@ -372,9 +926,36 @@ def order_process(id):
 def order_delete(id):
     order = Order.query.get_or_404(id)
     try:
+        sales.record_sale(db.session, order.product_id, order.date, delta=-1)
         db.session.delete(order)
         db.session.commit()
-        return redirect('/admin')
+        return redirect('/admin/orders')
+    except:
+        return "ERROR"
+
+
+@app.route('/admin/orders/batch', methods=['POST'])
+@auth_required
+def orders_batch():
+    ids = bulk.parse_ids(request.form.getlist('ids'))
+    action = request.form.get('action')
+    if not ids or action not in ('process', 'unprocess', 'delete'):
+        return redirect('/admin/orders')
+
+    try:
+        if action == 'delete':
+            removed = {}
+            for product_id, date in db.session.query(Order.product_id, Order.date).filter(Order.id.in_(ids)):
+                key = (product_id, sales.month_key(date))
+                removed[key] = (date, removed.get(key, (None, 0))[1] + 1)
+            for (product_id, _), (date, count) in removed.items():
+                sales.record_sale(db.session, product_id, date, delta=-count)
+            Order.query.filter(Order.id.in_(ids)).delete(synchronize_session=False)
+        else:
+            Order.query.filter(Order.id.in_(ids))\
+                .update({Order.processed: action == 'process'}, synchronize_session=False)
+        db.session.commit()
+        return redirect('/admin/orders')
     except:
         return "ERROR"
 
@@ -387,6 +968,9 @@ def product_visibility(id):
     product.visibility = not product.visibility
 
     try:
+        db.session.flush()
+        catalog.refresh_category(db.session, product.categories)
+        bump_catalog_version()
         db.session.commit()
         return redirect('/admin')
     except:
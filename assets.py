@@ -0,0 +1,137 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+from flask import request, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+FINGERPRINT = re.compile(r'^(.+)\.([0-9a-f]{10})(\.[^./]+)$')
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.html'}
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def _write_atomic(path, data):
+    # A unique temp name per call, so workers precompressing at boot do not write into each other's file.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp creates the file 0600; the web server has to be able to read it.
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class AssetManifest:
+    """Rewrites url_for('static') to content-hashed names and serves those with a one-year immutable cache.
+
+    css/app.css -> css/app.<hash>.css. Text assets are served from precompressed .br/.gz siblings
+    when the client accepts them.
+    """
+
+    def __init__(self, app=None):
+        self.static_folder = None
+        self.max_age = 365 * 24 * 60 * 60
+        self._hashes = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        self.max_age = app.config.get('ASSETS_MAX_AGE', self.max_age)
+        app.url_defaults(self._rewrite_static_url)
+        app.view_functions['static'] = self.send_static
+        if app.config.get('ASSETS_PRECOMPRESS'):
+            self.compress_all()
+
+    def _full_path(self, filename):
+        return os.path.join(self.static_folder, *filename.split('/'))
+
+    def file_hash(self, filename):
+        with self._lock:
+            if filename in self._hashes:
+                return self._hashes[filename]
+        try:
+            with open(self._full_path(filename), 'rb') as f:
+                digest = hashlib.md5(f.read()).hexdigest()[:10]
+        except OSError:
+            digest = None
+        with self._lock:
+            self._hashes[filename] = digest
+        return digest
+
+    def fingerprint(self, filename):
+        digest = self.file_hash(filename)
+        if not digest:
+            return filename
+        stem, extension = os.path.splitext(filename)
+        return '%s.%s%s' % (stem, digest, extension)
+
+    def _rewrite_static_url(self, endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            values['filename'] = self.fingerprint(values['filename'])
+
+    def send_static(self, filename):
+        immutable = False
+        match = FINGERPRINT.match(filename)
+        if match:
+            original = match.group(1) + match.group(3)
+            if self.file_hash(original) == match.group(2):
+                filename, immutable = original, True
+            elif os.path.isfile(self._full_path(original)):
+                # Stale hash from an old page: serve the current file, but do not pin it.
+                filename = original
+
+        extension = os.path.splitext(filename)[1].lower()
+        served, encoding = filename, None
+        if extension in COMPRESSIBLE:
+            for name, suffix in ENCODINGS:
+                if request.accept_encodings[name] and os.path.isfile(self._full_path(filename + suffix)):
+                    served, encoding = filename + suffix, name
+                    break
+
+        options = {'mimetype': mimetypes.guess_type(filename)[0] or 'application/octet-stream'}
+        if immutable:
+            options['cache_timeout'] = self.max_age
+        response = send_from_directory(self.static_folder, served, **options)
+
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if extension in COMPRESSIBLE:
+            response.vary.add('Accept-Encoding')
+        if immutable:
+            response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % self.max_age
+        return response
+
+    def compress_all(self):
+        """Write .gz (and .br when brotli is installed) next to every text asset that changed."""
+        for root, _, files in os.walk(self.static_folder):
+            for name in files:
+                if os.path.splitext(name)[1].lower() not in COMPRESSIBLE:
+                    continue
+                path = os.path.join(root, name)
+                mtime = os.path.getmtime(path)
+                data = None
+                for encoding, suffix in ENCODINGS:
+                    if encoding == 'br' and brotli is None:
+                        continue
+                    target = path + suffix
+                    if os.path.exists(target) and os.path.getmtime(target) >= mtime:
+                        continue
+                    if data is None:
+                        with open(path, 'rb') as f:
+                            data = f.read()
+                    if encoding == 'br':
+                        _write_atomic(target, brotli.compress(data))
+                    else:
+                        _write_atomic(target, gzip.compress(data, compresslevel=9))
@@ -0,0 +1,30 @@
+"""Benchmarks against a generated catalog.
+
+    python -m benchmarks.generate --products 20000 --orders 100000
+    python -m benchmarks.micro --baseline benchmarks/results/baseline-micro.json
+    python -m benchmarks.load --workers 4 --concurrency 16
+    python -m benchmarks.compare benchmarks/results/new.json benchmarks/results/baseline-micro.json
+
+Everything runs against bench.db (--database), never shop.db.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_DATABASE = os.path.join(ROOT, 'bench.db')
+
+
+def database_url(path):
+    return 'sqlite:///' + os.path.abspath(path)
+
+
+def load_app(path):
+    """Import the app bound to the benchmark database; config.py reads DATABASE_URL at import time."""
+    if os.path.abspath(path) == os.path.join(ROOT, 'shop.db'):
+        raise SystemExit('Refusing to benchmark against shop.db')
+    os.environ['DATABASE_URL'] = database_url(path)
+    os.environ.setdefault('ORDER_INTAKE', 'sync')
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import app
+    return app
@@ -0,0 +1,22 @@
+"""Compare two benchmark result files; exits 1 when a scenario regressed."""
+import argparse
+
+from benchmarks import stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('results')
+    parser.add_argument('baseline')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed p95/throughput change')
+    args = parser.parse_args()
+
+    results = stats.load(args.results)
+    comparison = stats.compare(results, stats.load(args.baseline), args.threshold)
+    stats.report(results, comparison)
+    if any(row[-1] for row in comparison):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""Fill the benchmark database with a synthetic catalog.
+
+Categories, authors and order popularity follow Zipf-like weights, so a few categories
+and authors hold most products and a few products get most orders, as in the real shop.
+"""
+import argparse
+import os
+import random
+from datetime import datetime, timedelta
+
+from benchmarks import DEFAULT_DATABASE, ROOT, load_app
+
+CATEGORIES = ['Декор', 'Изделия из мыла', 'Вышевка', 'Букеты', 'Сумки', 'Свечи', 'Бижутерия',
+              'Элементы интерьера', 'Декоративная посуда', 'Вещь', 'Быт', 'Шкатулки', 'Сувениры', 'Игрушки']
+NOUNS = ['Букет', 'Шкатулка', 'Свеча', 'Сумка', 'Мыло', 'Браслет', 'Кружка', 'Игрушка', 'Панно', 'Ваза',
+         'Серьги', 'Подсвечник', 'Корзина', 'Картина', 'Брошь', 'Тарелка', 'Сундук', 'Кулон']
+ADJECTIVES = ['Нежный', 'Весенний', 'Лесной', 'Морской', 'Яркий', 'Уютный', 'Старинный', 'Летний',
+              'Снежный', 'Золотой', 'Розовый', 'Медовый']
+WORDS = ['ручной', 'работы', 'подарок', 'дерево', 'лён', 'хлопок', 'воск', 'глина', 'узор', 'роспись',
+         'цветы', 'лаванда', 'декор', 'дом', 'праздник', 'уют', 'натуральный', 'авторский', 'винтаж']
+MATERIALS = ['Дерево', 'Хлопок', 'Лён', 'Воск', 'Глина', 'Стекло', 'Металл', 'Кожа', 'Бисер', 'Мыльная основа']
+COLORS = ['Белый', 'Красный', 'Зелёный', 'Синий', 'Жёлтый', 'Розовый', 'Чёрный', 'Бежевый', 'Фиолетовый']
+BATCH_SIZE = 2000
+
+
+def zipf_weights(n, s=1.1):
+    """Cumulative weights for random.choices: item i is picked in proportion to 1 / (i + 1) ** s."""
+    total, cumulative = 0.0, []
+    for i in range(n):
+        total += 1 / (i + 1) ** s
+        cumulative.append(total)
+    return cumulative
+
+
+def photos():
+    directory = os.path.join(ROOT, 'static', 'images', 'dest', 'photo')
+    return sorted('images/dest/photo/' + name for name in os.listdir(directory)
+                  if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def generate(app, products, orders, authors, months, seed):
+    rng = random.Random(seed)
+    db = app.db
+    now = datetime.utcnow()
+    start = now - timedelta(days=30 * months)
+    images = photos()
+    author_names = ['Мастер %03d' % (i + 1) for i in range(authors)]
+    category_weights = zipf_weights(len(CATEGORIES))
+    author_weights = zipf_weights(len(author_names))
+
+    lookups = {}
+    for model, names in ((app.Author, author_names), (app.Material, MATERIALS), (app.Color, COLORS)):
+        db.session.bulk_insert_mappings(model, [{'id': i + 1, 'name': name} for i, name in enumerate(names)])
+        lookups[model] = {name: i + 1 for i, name in enumerate(names)}
+
+    product_dates = []
+    rows, image_rows = [], []
+    for product_id in range(1, products + 1):
+        paths = rng.sample(images, rng.randint(1, min(4, len(images))))
+        author = rng.choices(author_names, cum_weights=author_weights)[0]
+        material, color = rng.choice(MATERIALS), rng.choice(COLORS)
+        date = start + (now - start) * rng.random()
+        product_dates.append(date)
+        rows.append({'id': product_id,
+                     'title': '%s %s №%d' % (rng.choice(ADJECTIVES), rng.choice(NOUNS).lower(), product_id),
+                     'desc': sentence(rng, 40),
+                     'desc_opt': sentence(rng, 8),
+                     'date': date,
+                     'visibility': rng.random() < 0.95,
+                     'price': rng.randint(5, 500) * 10,
+                     'categories': rng.choices(CATEGORIES, cum_weights=category_weights)[0],
+                     'image': ' '.join(paths),
+                     'primary_image': paths[0],
+                     'author': author,
+                     'author_id': lookups[app.Author][author],
+                     'availability': rng.randint(0, 20),
+                     'assignment': rng.choice(WORDS),
+                     'material': material,
+                     'material_id': lookups[app.Material][material],
+                     'material_opt': rng.choice(MATERIALS),
+                     'color': color,
+                     'color_id': lookups[app.Color][color],
+                     'color_opt': rng.choice(COLORS),
+                     'size': '%dx%d см' % (rng.randint(5, 60), rng.randint(5, 60)),
+                     'weight': '%d г' % rng.randint(20, 3000),
+                     'guarantee': '%d мес.' % rng.choice([0, 1, 3, 6, 12])})
+        image_rows.extend({'product_id': product_id, 'path': path, 'position': position,
+                           'is_primary': position == 0} for position, path in enumerate(paths))
+        if len(rows) >= BATCH_SIZE:
+            db.session.bulk_insert_mappings(app.Product, rows)
+            db.session.bulk_insert_mappings(app.ProductImage, image_rows)
+            rows, image_rows = [], []
+    db.session.bulk_insert_mappings(app.Product, rows)
+    db.session.bulk_insert_mappings(app.ProductImage, image_rows)
+
+    # Popularity is independent of age: shuffle which products sit at the head of the curve.
+    popular = list(range(1, products + 1))
+    rng.shuffle(popular)
+    popularity_weights = zipf_weights(products, s=0.9)
+    rows = []
+    for order_id in range(1, orders + 1):
+        product_id = rng.choices(popular, cum_weights=popularity_weights)[0]
+        created = product_dates[product_id - 1]
+        date = created + (now - created) * rng.random()
+        rows.append({'id': order_id,
+                     'product_id': product_id,
+                     'name': 'Покупатель %d' % rng.randint(1, orders),
+                     'phone': '+7%010d' % rng.randint(0, 10 ** 10 - 1),
+                     'address': 'ул. Садовая, %d' % rng.randint(1, 200),
+                     'post_index': '%06d' % rng.randint(100000, 999999),
+                     'email': 'buyer%d@example.com' % order_id,
+                     'comment': '',
+                     'processed': date < now - timedelta(days=7) or rng.random() < 0.3,
+                     'date': date,
+                     'idempotency_key': '%032x' % rng.getrandbits(128)})
+        if len(rows) >= BATCH_SIZE:
+            db.session.bulk_insert_mappings(app.Order, rows)
+            rows = []
+    db.session.bulk_insert_mappings(app.Order, rows)
+    db.session.flush()
+
+    connection = db.session.connection()
+    app.search_index.rebuild(connection)
+    app.catalog.rebuild_categories(connection)
+    app.sales.rebuild_sales(connection)
+    app.bump_catalog_version()
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default=DEFAULT_DATABASE)
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--orders', type=int, default=50000)
+    parser.add_argument('--authors', type=int, default=200)
+    parser.add_argument('--months', type=int, default=24, help='spread product and order dates over this period')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--force', action='store_true', help='replace an existing benchmark database')
+    args = parser.parse_args()
+
+    if os.path.exists(args.database):
+        if not args.force:
+            raise SystemExit('%s exists; pass --force to replace it' % args.database)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.database + suffix):
+                os.remove(args.database + suffix)
+
+    app = load_app(args.database)
+    with app.app.app_context():
+        generate(app, args.products, args.orders, args.authors, args.months, args.seed)
+    print('%s: %d products, %d orders' % (args.database, args.products, args.orders))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Load-test the app under gunicorn with several workers and concurrent clients."""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from benchmarks import DEFAULT_DATABASE, ROOT, database_url, stats
+from benchmarks.scenarios import SCENARIOS, Catalog
+
+# Share of requests per scenario, roughly the shape of real traffic.
+DEFAULT_MIX = 'index=20,search=10,category_product=15,author_product=5,all_products=10,product=38,buy=2'
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in SCENARIOS:
+            raise SystemExit('Unknown scenario %r' % name)
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def start_server(args):
+    env = dict(os.environ, DATABASE_URL=database_url(args.database), DB_AUTO_MIGRATE='0')
+    # gunicorn 20.0 has no __main__, so go through its console-script entry point.
+    command = [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+               '--workers', str(args.workers), '--bind', '127.0.0.1:%d' % args.port, '--log-level', 'warning']
+    command += args.gunicorn_args.split() + ['app:app']
+    server = subprocess.Popen(command, cwd=ROOT, env=env)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit('gunicorn exited with %d' % server.returncode)
+        try:
+            urlopen('http://127.0.0.1:%d/' % args.port, timeout=5).read()
+            return server
+        except (URLError, ConnectionError):
+            time.sleep(0.5)
+    server.terminate()
+    raise SystemExit('gunicorn did not start within 60 seconds')
+
+
+def fetch(base, method, path, form):
+    data = urlencode(form).encode('utf-8') if form else None
+    try:
+        with urlopen(Request(base + path, data=data, method=method), timeout=30) as response:
+            response.read()
+            return response.status
+    except HTTPError as e:
+        return e.code
+    except (URLError, ConnectionError, TimeoutError):
+        return 0
+
+
+def client(base, catalog, mix, seed, warmup_until, deadline, samples, lock):
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    while time.monotonic() < deadline:
+        scenario = rng.choices(names, weights)[0]
+        method, path, form = catalog.request(scenario, rng)
+        start = time.perf_counter()
+        status = fetch(base, method, path, form)
+        elapsed = time.perf_counter() - start
+        if time.monotonic() >= warmup_until:
+            with lock:
+                samples[scenario].append((elapsed, status == 200))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database', default=DEFAULT_DATABASE)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker processes')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--gunicorn-args', default='', help='extra gunicorn options, e.g. "--threads 4"')
+    parser.add_argument('--url', help='load an already running server instead of starting gunicorn')
+    parser.add_argument('--concurrency', type=int, default=16, help='client threads')
+    parser.add_argument('--duration', type=float, default=30, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds before measuring starts')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='scenario=weight,...')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='where to write the JSON results (default benchmarks/results/)')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed p95/throughput change')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    catalog = Catalog(args.database)
+    server = None if args.url else start_server(args)
+    base = (args.url or 'http://127.0.0.1:%d' % args.port).rstrip('/')
+
+    samples, lock = defaultdict(list), threading.Lock()
+    warmup_until = time.monotonic() + args.warmup
+    deadline = warmup_until + args.duration
+    threads = [threading.Thread(target=client, args=(base, catalog, mix, args.seed + i, warmup_until, deadline,
+                                                     samples, lock))
+               for i in range(args.concurrency)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    results = {'kind': 'load',
+               'environment': stats.environment(),
+               'parameters': {'products': len(catalog.product_ids), 'workers': args.workers,
+                              'gunicorn_args': args.gunicorn_args, 'url': args.url,
+                              'concurrency': args.concurrency, 'duration': args.duration,
+                              'warmup': args.warmup, 'mix': mix, 'seed': args.seed},
+               'scenarios': {}}
+    everything = []
+    for scenario in SCENARIOS:
+        if samples[scenario]:
+            everything.extend(samples[scenario])
+            results['scenarios'][scenario] = stats.summarize([elapsed for elapsed, _ in samples[scenario]],
+                                                             args.duration,
+                                                             sum(1 for _, ok in samples[scenario] if not ok))
+    results['scenarios']['total'] = stats.summarize([elapsed for elapsed, _ in everything], args.duration,
+                                                    sum(1 for _, ok in everything if not ok))
+
+    comparison = stats.compare(results, stats.load(args.baseline), args.threshold) if args.baseline else None
+    stats.report(results, comparison)
+    print('\nResults written to %s' % stats.save(results, args.output))
+    if comparison and any(row[-1] for row in comparison):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Time each page in-process through the Flask test client."""
+import argparse
+import random
+import time
+
+from benchmarks import DEFAULT_DATABASE, load_app, stats
+from benchmarks.scenarios import Catalog, parse_scenarios
+
+
+def run(client, catalog, scenario, iterations, warmup, rng):
+    for _ in range(warmup):
+        method, path, form = catalog.request(scenario, rng)
+        client.open(path, method=method, data=form)
+
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for _ in range(iterations):
+        method, path, form = catalog.request(scenario, rng)
+        start = time.perf_counter()
+        response = client.open(path, method=method, data=form)
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            errors += 1
+    return stats.summarize(latencies, time.perf_counter() - started, errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database', default=DEFAULT_DATABASE)
+    parser.add_argument('--scenarios', help='comma-separated subset of the scenarios')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--cold', action='store_true', help='bypass the page and fragment cache')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='where to write the JSON results (default benchmarks/results/)')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed p95/throughput change')
+    args = parser.parse_args()
+
+    scenarios = parse_scenarios(args.scenarios)
+    catalog = Catalog(args.database)
+    app = load_app(args.database)
+    if args.cold:
+        from cache import NullCache
+        app.page_cache.backend = NullCache()
+
+    rng = random.Random(args.seed)
+    client = app.app.test_client()
+    results = {'kind': 'micro',
+               'environment': stats.environment(),
+               'parameters': {'products': len(catalog.product_ids), 'iterations': args.iterations,
+                              'warmup': args.warmup, 'cold': args.cold, 'seed': args.seed},
+               'scenarios': {}}
+    for scenario in scenarios:
+        results['scenarios'][scenario] = run(client, catalog, scenario, args.iterations, args.warmup, rng)
+
+    comparison = stats.compare(results, stats.load(args.baseline), args.threshold) if args.baseline else None
+    stats.report(results, comparison)
+    print('\nResults written to %s' % stats.save(results, args.output))
+    if comparison and any(row[-1] for row in comparison):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
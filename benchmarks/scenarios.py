@@ -0,0 +1,66 @@
+"""The requests each benchmark scenario sends, drawn from what is in the benchmark database."""
+import re
+import uuid
+from urllib.parse import quote
+
+from sqlalchemy import create_engine, text
+
+from benchmarks import database_url
+
+# buy is last because it is the only scenario that writes. Orders leave the catalog version and the
+# page cache alone, but running it after the reads keeps them measuring the database as generated.
+SCENARIOS = ['index', 'search', 'category_product', 'author_product', 'all_products', 'product', 'buy']
+PER_PAGE = 12
+
+
+class Catalog:
+    """Ids, names and search words sampled once from the database, so request building stays cheap."""
+
+    def __init__(self, path):
+        engine = create_engine(database_url(path))
+        with engine.connect() as conn:
+            visible = {'visible': True}
+            self.product_ids = [row[0] for row in conn.execute(
+                text('SELECT id FROM product WHERE visibility = :visible'), visible)]
+            self.categories = [row[0] for row in conn.execute(text('SELECT name FROM category'))]
+            self.authors = [row[0] for row in conn.execute(text(
+                'SELECT DISTINCT author.name FROM author JOIN product ON product.author_id = author.id '
+                'WHERE product.visibility = :visible'), visible)]
+            titles = [row[0] for row in conn.execute(text('SELECT title FROM product LIMIT 500'))]
+        engine.dispose()
+        self.words = sorted({word for title in titles for word in re.findall(r'[^\W\d]{4,}', title.lower())})
+        self.pages = max(1, (len(self.product_ids) + PER_PAGE - 1) // PER_PAGE)
+        if not self.product_ids:
+            raise SystemExit('The benchmark database has no products; run python -m benchmarks.generate first')
+
+    def request(self, scenario, rng):
+        """(method, path, form) for one request of the scenario."""
+        if scenario == 'index':
+            return 'GET', '/', None
+        if scenario == 'search':
+            return 'GET', '/search/?search=' + quote(rng.choice(self.words)), None
+        if scenario == 'category_product':
+            # Page 1 lives at /category/<name>; /category/<name>/1 redirects there.
+            page = rng.randint(1, 3)
+            path = '/category/' + quote(rng.choice(self.categories))
+            return 'GET', path if page == 1 else '%s/%d' % (path, page), None
+        if scenario == 'author_product':
+            return 'GET', '/author/' + quote(rng.choice(self.authors)), None
+        if scenario == 'all_products':
+            return 'GET', '/all_products/%d' % rng.randint(1, self.pages), None
+        if scenario == 'product':
+            return 'GET', '/product/%d' % rng.choice(self.product_ids), None
+        if scenario == 'buy':
+            return 'POST', '/buy/%d' % rng.choice(self.product_ids), {
+                'name': 'Benchmark', 'phone': '+70000000000', 'address': 'ул. Тестовая, 1',
+                'post_index': '100000', 'email': 'bench@example.com', 'comment': '',
+                'idempotency_key': uuid.UUID(int=rng.getrandbits(128)).hex}
+        raise ValueError('Unknown scenario %r' % scenario)
+
+
+def parse_scenarios(value):
+    names = value.split(',') if value else SCENARIOS
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit('Unknown scenarios: %s' % ', '.join(sorted(unknown)))
+    return [name for name in SCENARIOS if name in names]
@@ -0,0 +1,91 @@
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+
+from benchmarks import ROOT
+
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values), math.ceil(q / 100 * len(sorted_values))) - 1)
+    return sorted_values[rank]
+
+
+def summarize(latencies, elapsed, errors=0):
+    """Latencies in seconds -> milliseconds percentiles and requests per second."""
+    values = sorted(latencies)
+    count = len(values)
+    return {'count': count,
+            'errors': errors,
+            'rps': round(count / elapsed, 1) if elapsed else 0.0,
+            'mean_ms': round(sum(values) / count * 1000, 2) if count else 0.0,
+            'p50_ms': round(percentile(values, 50) * 1000, 2),
+            'p95_ms': round(percentile(values, 95) * 1000, 2),
+            'p99_ms': round(percentile(values, 99) * 1000, 2),
+            'max_ms': round(values[-1] * 1000, 2) if count else 0.0}
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {'date': datetime.utcnow().isoformat(timespec='seconds'),
+            'commit': commit,
+            'python': sys.version.split()[0],
+            'platform': platform.platform()}
+
+
+def save(results, path=None):
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, '%s-%s.json' % (results['kind'], datetime.utcnow().strftime('%Y%m%d-%H%M%S')))
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compare(current, baseline, threshold=0.1):
+    """Rows of (scenario, baseline p95, current p95, baseline rps, current rps, regressed).
+
+    A scenario regressed when its p95 grew, or its throughput fell, by more than threshold.
+    """
+    rows = []
+    for name, now in current['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if not before:
+            continue
+        regressed = (now['p95_ms'] > before['p95_ms'] * (1 + threshold) or
+                     now['rps'] < before['rps'] * (1 - threshold) or
+                     now['errors'] > before['errors'])
+        rows.append((name, before['p95_ms'], now['p95_ms'], before['rps'], now['rps'], regressed))
+    return rows
+
+
+def report(results, comparison=None):
+    print('%-18s %7s %6s %9s %9s %9s %9s %9s' % ('scenario', 'count', 'errors', 'rps', 'p50 ms', 'p95 ms',
+                                                'p99 ms', 'max ms'))
+    for name, row in results['scenarios'].items():
+        print('%-18s %7d %6d %9.1f %9.2f %9.2f %9.2f %9.2f' % (name, row['count'], row['errors'], row['rps'],
+                                                              row['p50_ms'], row['p95_ms'], row['p99_ms'],
+                                                              row['max_ms']))
+    if comparison:
+        print()
+        print('%-18s %12s %12s %10s %10s' % ('vs baseline', 'p95 before', 'p95 now', 'rps before', 'rps now'))
+        for name, p95_before, p95_now, rps_before, rps_now, regressed in comparison:
+            print('%-18s %12.2f %12.2f %10.1f %10.1f%s' % (name, p95_before, p95_now, rps_before, rps_now,
+                                                         '  REGRESSION' if regressed else ''))
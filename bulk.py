@@ -0,0 +1,111 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+# Columns an import may set; primary_image and the *_id lookups are derived from them on import.
+IMPORT_COLUMNS = ['id', 'title', 'desc', 'desc_opt', 'date', 'visibility', 'price', 'categories', 'image', 'author',
+                  'availability', 'assignment', 'material', 'material_opt', 'color', 'color_opt', 'size', 'weight',
+                  'guarantee']
+INTEGER_COLUMNS = {'id', 'price', 'availability'}
+MAX_LENGTHS = {'title': 80, 'desc_opt': 250, 'categories': 250, 'image': 250, 'author': 250, 'assignment': 250,
+               'material': 250, 'material_opt': 250, 'color': 250, 'color_opt': 250, 'size': 250, 'weight': 250,
+               'guarantee': 250}
+TRUE_VALUES = {'1', 'true', 'yes', 'on'}
+FALSE_VALUES = {'0', 'false', 'no', 'off', ''}
+
+
+def import_format(filename, requested=None):
+    """'csv' or 'jsonl', from the explicit choice or the file extension."""
+    if requested in ('csv', 'jsonl'):
+        return requested
+    return 'jsonl' if (filename or '').lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def read_rows(stream, format='csv'):
+    """Yield (line number, row dict or None, error) from a binary stream without reading it all into memory."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if format == 'jsonl':
+        for number, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield number, None, 'not valid JSON'
+                continue
+            if isinstance(row, dict):
+                yield number, row, None
+            else:
+                yield number, None, 'not a JSON object'
+        return
+
+    reader = csv.DictReader(text)
+    for row in reader:
+        # DictReader puts the header on line 1, so data starts on 2.
+        yield reader.line_num, row, None
+
+
+def _integer(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+        raise ValueError
+    return int(value)
+
+
+def _boolean(value):
+    if isinstance(value, bool):
+        return value
+    if value is None:
+        return True
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise ValueError
+
+
+def validate(row):
+    """Return (values, None) for an importable row or (None, error message)."""
+    values = {}
+    for column in IMPORT_COLUMNS:
+        if column not in row:
+            continue
+        value = row[column]
+        try:
+            if column in INTEGER_COLUMNS:
+                value = _integer(value)
+            elif column == 'visibility':
+                value = _boolean(value)
+            elif column == 'date':
+                value = datetime.fromisoformat(value) if value else None
+            elif value is not None:
+                value = str(value)
+        except (TypeError, ValueError):
+            return None, '%s: %r is not valid' % (column, value)
+        if column in MAX_LENGTHS and value and len(value) > MAX_LENGTHS[column]:
+            return None, '%s: longer than %d characters' % (column, MAX_LENGTHS[column])
+        if column == 'date' and value is None:
+            # Left out so new products get the column default.
+            continue
+        values[column] = value
+
+    if values.get('id') is not None and values['id'] <= 0:
+        return None, 'id: must be positive'
+    if values.get('price') is not None and values['price'] < 0:
+        return None, 'price: must not be negative'
+    if values.get('id') is None and not values.get('title'):
+        return None, 'title: required for new products'
+    return values, None
+
+
+def parse_ids(values):
+    """Form values like ['3', '5,7'] -> [3, 5, 7]; anything that is not an id is dropped."""
+    ids = []
+    for value in values:
+        for part in str(value).split(','):
+            if part.strip().isdigit():
+                ids.append(int(part))
+    return list(dict.fromkeys(ids))
@@ -0,0 +1,178 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import g, request, make_response
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+
+class NullCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache:
+    """In-process cache bounded by entry count, with per-entry expiry."""
+
+    def __init__(self, max_size=512, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires is not None and expires < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._items[key] = (expires, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class RedisCache:
+    """Cache shared by every worker. Needs the optional redis package."""
+
+    def __init__(self, url, ttl=300, prefix='shop:'):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self._redis.get(self.prefix + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(self.prefix + key, value.encode('utf-8'), ex=ttl or self.ttl or None)
+
+    def clear(self):
+        for key in self._redis.scan_iter(self.prefix + '*'):
+            self._redis.delete(key)
+
+
+def create_backend(config):
+    cache_type = config.get('CACHE_TYPE', 'lru')
+    if cache_type == 'null':
+        return NullCache()
+    if cache_type == 'redis':
+        return RedisCache(config['CACHE_REDIS_URL'], ttl=config.get('CACHE_TTL', 300))
+    if cache_type == 'lru':
+        return LRUCache(max_size=config.get('CACHE_MAX_SIZE', 512), ttl=config.get('CACHE_TTL', 300))
+    raise ValueError('Unknown CACHE_TYPE %r' % cache_type)
+
+
+class FragmentCacheExtension(Extension):
+    """{% cache 'name' %}...{% endcache %} renders its body once per catalog version."""
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(page_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache_support', [nodes.List(args)]), [], [], body) \
+            .set_lineno(lineno)
+
+    def _cache_support(self, names, caller):
+        page_cache = self.environment.page_cache
+        if page_cache is None:
+            return caller()
+        version, _ = page_cache.current_version()
+        key = 'fragment:%s:%s' % (version, ':'.join(str(name) for name in names))
+        rv = page_cache.backend.get(key)
+        if rv is None:
+            rv = caller()
+            page_cache.backend.set(key, rv)
+        return rv
+
+
+class PageCache:
+    """Caches rendered pages and template fragments until the catalog version changes.
+
+    version is a callable returning (version, last_modified); write routes bump it.
+    """
+
+    def __init__(self, app=None, version=None):
+        self.backend = NullCache()
+        self.version = version
+        if app is not None:
+            self.init_app(app, version)
+
+    def init_app(self, app, version=None):
+        self.backend = create_backend(app.config)
+        if version is not None:
+            self.version = version
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.jinja_env.page_cache = self
+
+    def current_version(self):
+        if 'catalog_version' not in g:
+            g.catalog_version = self.version()
+        return g.catalog_version
+
+    def cached(self, f):
+        return self._cached(f, 'text/html')
+
+    def cached_json(self, f):
+        return self._cached(f, 'application/json')
+
+    def _cached(self, f, mimetype):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if request.method != 'GET':
+                return f(*args, **kwargs)
+
+            version, last_modified = self.current_version()
+            key = 'page:%s:%s' % (version, request.full_path)
+            etag = hashlib.md5(key.encode('utf-8')).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+                response.set_etag(etag)
+                return response
+
+            body = self.backend.get(key)
+            if body is None:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                body = response.get_data(as_text=True)
+                self.backend.set(key, body)
+
+            response = make_response(body)
+            response.mimetype = mimetype
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            return response.make_conditional(request)
+        return decorated
@@ -0,0 +1,67 @@
+import random
+import threading
+from sqlalchemy import text
+
+
+def primary_image(image):
+    return (image or '').split(' ')[0]
+
+
+def refresh_category(bind, name):
+    """Recount one category's visible products and pick its newest product image as the tile."""
+    if not name:
+        return
+    row = bind.execute(text('SELECT count(*), '
+                            '(SELECT image FROM product WHERE visibility = :visible AND categories = :name '
+                            'ORDER BY date DESC LIMIT 1) '
+                            'FROM product WHERE visibility = :visible AND categories = :name'),
+                       {'name': name, 'visible': True}).first()
+    count, image = row[0], primary_image(row[1])
+
+    if not count:
+        bind.execute(text('DELETE FROM category WHERE name = :name'), {'name': name})
+        return
+    updated = bind.execute(text('UPDATE category SET image = :image, product_count = :count WHERE name = :name'),
+                           {'name': name, 'image': image, 'count': count})
+    if not updated.rowcount:
+        bind.execute(text('INSERT INTO category (name, image, product_count) VALUES (:name, :image, :count)'),
+                     {'name': name, 'image': image, 'count': count})
+
+
+def rebuild_categories(bind):
+    """Backfill the category table from the free-text Product.categories column."""
+    rows = bind.execute(text("SELECT categories, image FROM product "
+                             "WHERE visibility = :visible AND categories != '' ORDER BY date"),
+                        {'visible': True}).fetchall()
+    categories = {}
+    for name, image in rows:
+        count, _ = categories.get(name, (0, None))
+        categories[name] = (count + 1, primary_image(image))
+
+    bind.execute(text('DELETE FROM category'))
+    if categories:
+        bind.execute(text('INSERT INTO category (name, image, product_count) VALUES (:name, :image, :count)'),
+                     [{'name': name, 'image': image, 'count': count}
+                      for name, (count, image) in categories.items()])
+
+
+class ProductSampler:
+    """Keeps the visible product ids in memory and reloads them when the catalog version changes."""
+
+    def __init__(self):
+        self._version = None
+        self._ids = []
+        self._lock = threading.Lock()
+
+    def ids(self, bind, version):
+        with self._lock:
+            if version != self._version:
+                rows = bind.execute(text('SELECT id FROM product WHERE visibility = :visible'), {'visible': True})
+                self._ids = [row[0] for row in rows]
+                self._version = version
+            return self._ids
+
+    def sample(self, bind, version, k):
+        """Return up to k distinct visible product ids, uniformly at random."""
+        ids = self.ids(bind, version)
+        return random.sample(ids, min(k, len(ids)))
@@ -1,5 +1,41 @@
+import os
+
 USER = 'admin'
 PASSWORD = 'admin'
 
 UPLOAD_FOLDER = '/static/images/dest/photo'
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg'])
+
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///shop.db')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = True
+# Run pending migrations when a worker starts. Turn off where 'flask db-upgrade' runs as a release step.
+DB_AUTO_MIGRATE = os.environ.get('DB_AUTO_MIGRATE', '1') == '1'
+SQLITE_BUSY_TIMEOUT = 5000
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+
+CACHE_TYPE = 'lru'
+CACHE_MAX_SIZE = 512
+CACHE_TTL = 300
+CACHE_REDIS_URL = None
+
+ASSETS_MAX_AGE = 365 * 24 * 60 * 60
+ASSETS_PRECOMPRESS = True
+
+# 'sync' commits each order inside buy(); 'queued' journals it and lets a background writer group-commit.
+ORDER_INTAKE = os.environ.get('ORDER_INTAKE', 'sync')
+ORDER_JOURNAL_DIR = os.environ.get('ORDER_JOURNAL_DIR', 'journal')
+ORDER_QUEUE_MAX_PENDING = 1000
+ORDER_QUEUE_BATCH_SIZE = 100
+ORDER_QUEUE_INTERVAL = 0.2
+
+# Statements slower than this many seconds are logged with their parameters.
+METRICS_SLOW_QUERY = float(os.environ.get('METRICS_SLOW_QUERY', 0.1))
+# One request running the same statement this many times is logged as a likely N+1.
+METRICS_N_PLUS_ONE = 10
+METRICS_SERVER_TIMING = os.environ.get('METRICS_SERVER_TIMING', '0') == '1'
+
+# Rows per transaction in a bulk product import.
+IMPORT_BATCH_SIZE = 500
@@ -0,0 +1,61 @@
+from sqlalchemy import event, text
+from sqlalchemy.engine.url import make_url
+
+
+def database_uri(uri):
+    # Heroku still hands out postgres:// URLs.
+    if uri.startswith('postgres://'):
+        return 'postgresql://' + uri[len('postgres://'):]
+    return uri
+
+
+def engine_options(uri, pool_size, max_overflow, pool_recycle, pool_pre_ping):
+    """Pool settings for SQLALCHEMY_ENGINE_OPTIONS; SQLite keeps SQLAlchemy's own file pool."""
+    if make_url(uri).get_backend_name() == 'sqlite':
+        return {}
+    return {'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            'pool_recycle': pool_recycle,
+            'pool_pre_ping': pool_pre_ping}
+
+
+def configure_sqlite(engine, busy_timeout, mmap_size):
+    """Run every new SQLite connection in WAL mode so readers stop blocking on buy() and admin writes."""
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(connection, record):
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=%d' % busy_timeout)
+        cursor.execute('PRAGMA mmap_size=%d' % mmap_size)
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+def sync_sequence(bind, table, column='id'):
+    """Move a PostgreSQL serial past rows inserted with explicit ids; SQLite needs nothing."""
+    dialect = bind.dialect if hasattr(bind, 'dialect') else bind.get_bind().dialect
+    if dialect.name != 'postgresql':
+        return
+    bind.execute(text("SELECT setval(pg_get_serial_sequence(:table, :column), "
+                      "(SELECT max(%s) FROM %s))" % (column, table)), {'table': table, 'column': column})
+
+
+def reserve_ids(bind, table, count, column='id'):
+    """Hand out count unused ids so new rows can go in with one executemany.
+
+    PostgreSQL draws them from the serial; SQLite continues after max(id), which is only safe once
+    the transaction has written something and so holds the database write lock.
+    """
+    if not count:
+        return []
+    dialect = bind.dialect if hasattr(bind, 'dialect') else bind.get_bind().dialect
+    if dialect.name == 'postgresql':
+        return [row[0] for row in bind.execute(
+            text("SELECT nextval(pg_get_serial_sequence(:table, :column)) FROM generate_series(1, :count)"),
+            {'table': table, 'column': column, 'count': count})]
+    start = bind.execute(text("SELECT coalesce(max(%s), 0) + 1 FROM %s" % (column, table))).scalar()
+    return list(range(start, start + count))
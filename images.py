@@ -0,0 +1,125 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import url_for
+from markupsafe import Markup
+from PIL import Image, ImageOps
+
+PHOTO_DIR = 'images/dest/photo'
+VARIANT_DIR = 'images/dest/variants'
+# name, width in pixels
+VARIANTS = [('thumb', 160), ('card', 400), ('full', 1200)]
+FORMATS = [('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+           ('webp', 'WEBP', {'quality': 80, 'method': 4})]
+CARD_SIZES = '(max-width: 576px) 100vw, 300px'
+# Hex digits of the sha256 kept in upload names: short enough that several paths fit
+# Product.image (String(250)), long enough that collisions are not a concern.
+DIGEST_LENGTH = 20
+
+log = logging.getLogger(__name__)
+
+
+def _write_atomic(path, write):
+    # A unique temp name per call: two uploads of the same photo render the same variants at once.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    try:
+        # mkstemp creates the file 0600; the web server has to be able to read it.
+        os.chmod(tmp, 0o644)
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class ImagePipeline:
+    """Stores uploads under their content hash and renders resized variants in a worker pool."""
+
+    def __init__(self, static_folder, max_workers=2):
+        self.static_folder = static_folder
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._ready = set()
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        for directory in (PHOTO_DIR, VARIANT_DIR):
+            os.makedirs(self._full_path(directory), exist_ok=True)
+
+    def _full_path(self, path):
+        return os.path.join(self.static_folder, *path.split('/'))
+
+    def save_upload(self, image):
+        """Save a FileStorage once per distinct content and return its static path."""
+        data = image.read()
+        extension = image.filename.rsplit('.', 1)[1].lower().replace('jpeg', 'jpg')
+        path = '%s/%s.%s' % (PHOTO_DIR, hashlib.sha256(data).hexdigest()[:DIGEST_LENGTH], extension)
+
+        full_path = self._full_path(path)
+        if not os.path.exists(full_path):
+            def write(tmp):
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+            _write_atomic(full_path, write)
+        with self._lock:
+            if path in self._in_flight or self.has_variants(path):
+                return path
+            self._in_flight.add(path)
+        future = self._executor.submit(self.make_variants, path)
+        future.add_done_callback(lambda future: self._finish(future, path))
+        return path
+
+    def _finish(self, future, path):
+        with self._lock:
+            self._in_flight.discard(path)
+        error = future.exception()
+        if error is not None:
+            log.error('Could not render the variants of %s', path, exc_info=error)
+
+    def variant(self, path, name, extension):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        return '%s/%s-%s.%s' % (VARIANT_DIR, stem, name, extension)
+
+    def make_variants(self, path):
+        if self.has_variants(path):
+            return
+        with Image.open(self._full_path(path)) as original:
+            original = ImageOps.exif_transpose(original).convert('RGB')
+            for name, width in VARIANTS:
+                if original.width > width:
+                    resized = original.resize((width, round(original.height * width / original.width)),
+                                              Image.LANCZOS)
+                else:
+                    resized = original
+                for extension, format, options in FORMATS:
+                    _write_atomic(self._full_path(self.variant(path, name, extension)),
+                                  lambda tmp: resized.save(tmp, format, **options))
+
+    def has_variants(self, path):
+        if path in self._ready:
+            return True
+        last_name, _ = VARIANTS[-1]
+        last_extension = FORMATS[-1][0]
+        if os.path.exists(self._full_path(self.variant(path, last_name, last_extension))):
+            self._ready.add(path)
+            return True
+        return False
+
+    def srcset(self, path, extension='jpg'):
+        return ', '.join('%s %dw' % (url_for('static', filename=self.variant(path, name, extension)), width)
+                         for name, width in VARIANTS)
+
+    def picture(self, path, class_='', alt='', sizes=CARD_SIZES, width=None, height=None):
+        """<picture> with WebP and JPEG srcsets, or a plain <img> until the variants exist."""
+        dimensions = Markup(' width="%s" height="%s"') % (width, height) if width and height else ''
+        if not path or not self.has_variants(path):
+            src = url_for('static', filename=path) if path else ''
+            return Markup('<img src="%s" alt="%s" class="%s"%s>') % (src, alt, class_, dimensions)
+        return Markup('<picture>'
+                      '<source type="image/webp" srcset="%s" sizes="%s">'
+                      '<img src="%s" srcset="%s" sizes="%s" alt="%s" class="%s"%s loading="lazy">'
+                      '</picture>') % (self.srcset(path, 'webp'), sizes,
+                                       url_for('static', filename=self.variant(path, 'card', 'jpg')),
+                                       self.srcset(path), sizes, alt, class_, dimensions)
@@ -0,0 +1,80 @@
+import csv
+import io
+import json
+from datetime import datetime
+from sqlalchemy import and_, or_
+
+CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def parse_cursor(value):
+    """'<date>_<id>' -> (datetime, id), or None for the first page."""
+    if not value:
+        return None
+    try:
+        date, id = value.rsplit('_', 1)
+        return datetime.strptime(date, CURSOR_FORMAT), int(id)
+    except ValueError:
+        return None
+
+
+def make_cursor(row):
+    return '%s_%d' % (row.date.strftime(CURSOR_FORMAT), row.id)
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+
+def keyset_page(query, model, cursor=None, descending=False, per_page=50):
+    """Seek past cursor on (date, id) instead of OFFSET; return (items, cursor of the next page)."""
+    if cursor:
+        date, id = cursor
+        if descending:
+            query = query.filter(or_(model.date < date, and_(model.date == date, model.id < id)))
+        else:
+            query = query.filter(or_(model.date > date, and_(model.date == date, model.id > id)))
+
+    if descending:
+        query = query.order_by(model.date.desc(), model.id.desc())
+    else:
+        query = query.order_by(model.date, model.id)
+
+    items = query.limit(per_page + 1).all()
+    next_cursor = make_cursor(items[per_page - 1]) if len(items) > per_page else None
+    return items[:per_page], next_cursor
+
+
+def _value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def export_rows(query, columns, format='csv', batch_size=500):
+    """Yield the query's rows as CSV, a JSON array or JSON lines, one chunk per row."""
+    rows = query.yield_per(batch_size)
+    if format == 'jsonl':
+        for row in rows:
+            yield json.dumps({column: _value(getattr(row, column)) for column in columns}, ensure_ascii=False) + '\n'
+        return
+    if format == 'json':
+        yield '['
+        for number, row in enumerate(rows):
+            item = {column: _value(getattr(row, column)) for column in columns}
+            yield (',' if number else '') + json.dumps(item, ensure_ascii=False)
+        yield ']'
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_value(getattr(row, column)) for column in columns])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
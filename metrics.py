@@ -0,0 +1,190 @@
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+# Numbers and quoted strings are stripped so the same query with other literals counts as one statement.
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(names, values):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in zip(names, values))
+
+
+class Registry:
+    """Counters and histograms keyed by label values, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _metric(self, name, kind, help, labels, buckets=None):
+        if name not in self._metrics:
+            factory = (lambda: Histogram(buckets)) if kind == 'histogram' else float
+            self._metrics[name] = (kind, help, labels, defaultdict(factory))
+        return self._metrics[name][3]
+
+    def inc(self, name, help, labels=(), values=(), amount=1):
+        with self._lock:
+            self._metric(name, 'counter', help, labels)[tuple(values)] += amount
+
+    def observe(self, name, help, value, labels=(), values=(), buckets=LATENCY_BUCKETS):
+        with self._lock:
+            self._metric(name, 'histogram', help, labels, buckets)[tuple(values)].observe(value)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, help, labels, series) in sorted(self._metrics.items()):
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for values, metric in sorted(series.items()):
+                    label = _labels(labels, values)
+                    if kind == 'counter':
+                        lines.append('%s{%s} %s' % (name, label, metric) if label else '%s %s' % (name, metric))
+                        continue
+                    prefix = label + ',' if label else ''
+                    for bound, count in zip(metric.buckets, metric.counts):
+                        lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, bound, count))
+                    lines.append('%s_bucket{%sle="+Inf"} %d' % (name, prefix, metric.count))
+                    lines.append('%s_sum%s %s' % (name, '{%s}' % label if label else '', metric.sum))
+                    lines.append('%s_count%s %d' % (name, '{%s}' % label if label else '', metric.count))
+        return '\n'.join(lines) + '\n'
+
+
+class RequestStats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.statements = Counter()
+
+
+def _request_stats():
+    if has_request_context():
+        return getattr(g, '_request_stats', None)
+    return None
+
+
+class Metrics:
+    """Per-request timings, SQL counts, template render time and a slow-query log.
+
+    Every request records its latency per endpoint, how many statements it ran and how long
+    they took, and how long its templates took to render. Statements slower than
+    METRICS_SLOW_QUERY are logged with their parameters; a statement repeated
+    METRICS_N_PLUS_ONE times or more in one request is logged as a likely N+1.
+    With METRICS_SERVER_TIMING on, responses carry a Server-Timing header with the same numbers.
+
+    The registry lives in the worker process: under gunicorn each worker reports its own series.
+    """
+
+    def __init__(self, app=None, engine=None):
+        self.registry = Registry()
+        self.slow_query = 0.1
+        self.n_plus_one = 10
+        self.server_timing = False
+        if app is not None:
+            self.init_app(app, engine)
+
+    def init_app(self, app, engine):
+        self.slow_query = app.config.get('METRICS_SLOW_QUERY', self.slow_query)
+        self.n_plus_one = app.config.get('METRICS_N_PLUS_ONE', self.n_plus_one)
+        self.server_timing = app.config.get('METRICS_SERVER_TIMING', self.server_timing)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.jinja_env.template_class = self._timed_template_class(app.jinja_env.template_class)
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _timed_template_class(self, base):
+        metrics = self
+
+        class TimedTemplate(base):
+            def render(self, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return super().render(*args, **kwargs)
+                finally:
+                    metrics._template_rendered(self.name, time.perf_counter() - start)
+
+        return TimedTemplate
+
+    def _template_rendered(self, name, elapsed):
+        stats = _request_stats()
+        if stats is not None:
+            stats.template_time += elapsed
+        self.registry.observe('template_render_seconds', 'Time spent rendering a template.', elapsed,
+                              ('template',), (name,))
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        stats = _request_stats()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += elapsed
+            stats.statements[_LITERALS.sub('?', statement)] += 1
+
+        if elapsed >= self.slow_query:
+            endpoint = request.endpoint if stats is not None else None
+            self.registry.inc('db_slow_queries_total', 'Statements slower than the slow-query threshold.')
+            log.warning('Slow query (%.1f ms, %s): %s %r', elapsed * 1000, endpoint or '-', statement, parameters)
+
+    def _before_request(self):
+        g._request_stats = RequestStats()
+
+    def _after_request(self, response):
+        stats = _request_stats()
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - stats.start
+        endpoint = request.endpoint or 'unknown'
+
+        self.registry.observe('http_request_duration_seconds', 'Request latency.', elapsed,
+                              ('endpoint', 'method'), (endpoint, request.method))
+        self.registry.inc('http_requests_total', 'Requests served.',
+                          ('endpoint', 'method', 'status'), (endpoint, request.method, response.status_code))
+        self.registry.observe('db_queries_per_request', 'SQL statements run by one request.', stats.queries,
+                              ('endpoint',), (endpoint,), buckets=QUERY_COUNT_BUCKETS)
+        self.registry.inc('db_query_seconds_total', 'Time spent in SQL statements.',
+                          ('endpoint',), (endpoint,), stats.db_time)
+
+        for statement, count in stats.statements.items():
+            if count >= self.n_plus_one:
+                self.registry.inc('db_n_plus_one_total', 'Requests that repeated one statement many times.',
+                                  ('endpoint',), (endpoint,))
+                log.warning('Possible N+1 in %s: %d x %s', endpoint, count, statement)
+
+        if self.server_timing:
+            response.headers.add('Server-Timing', 'app;dur=%.1f, db;dur=%.1f;desc="%d queries", tpl;dur=%.1f'
+                                 % (elapsed * 1000, stats.db_time * 1000, stats.queries, stats.template_time * 1000))
+        return response
+
+    def render(self):
+        return self.registry.render()
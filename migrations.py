@@ -0,0 +1,172 @@
+from contextlib import contextmanager
+from sqlalchemy import inspect, text
+import search as search_index
+import catalog
+import sales
+
+MIGRATIONS_TABLE = 'schema_migrations'
+# pg_advisory_lock key held while upgrading; any constant other code does not use.
+LOCK_KEY = 7300371
+
+
+def search_table(conn):
+    search_index.create_index(conn)
+    search_index.rebuild(conn)
+
+
+def product_filter_indexes(conn):
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_product_visibility_categories_date '
+                      'ON product (visibility, categories, date)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_product_visibility_author_date '
+                      'ON product (visibility, author, date)'))
+
+
+def category_table(conn):
+    catalog.rebuild_categories(conn)
+
+
+def order_indexes_and_sales(conn):
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_order_product_id ON "order" (product_id)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_order_date ON "order" (date)'))
+    sales.rebuild_sales(conn)
+
+
+def catalog_version_row(conn):
+    if not conn.execute(text('SELECT id FROM catalog_version WHERE id = 1')).first():
+        conn.execute(text('INSERT INTO catalog_version (id, version, updated) VALUES (1, 0, CURRENT_TIMESTAMP)'))
+
+
+def product_date_index(conn):
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_product_date ON product (date)'))
+
+
+def add_column(conn, table, column, definition):
+    if column not in {c['name'] for c in inspect(conn).get_columns(table)}:
+        conn.execute(text('ALTER TABLE %s ADD COLUMN %s %s'
+                          % (conn.dialect.identifier_preparer.quote(table), column, definition)))
+
+
+def lookup(conn, table, name, cache):
+    if not name:
+        return None
+    if name not in cache:
+        row = conn.execute(text('SELECT id FROM %s WHERE name = :name' % table), {'name': name}).first()
+        if row is None:
+            conn.execute(text('INSERT INTO %s (name) VALUES (:name)' % table), {'name': name})
+            row = conn.execute(text('SELECT id FROM %s WHERE name = :name' % table), {'name': name}).first()
+        cache[name] = row[0]
+    return cache[name]
+
+
+def normalized_product_schema(conn):
+    """Split Product.image into product_image rows and author/material/color into lookup tables."""
+    add_column(conn, 'product', 'primary_image', 'VARCHAR(250)')
+    add_column(conn, 'product', 'author_id', 'INTEGER REFERENCES author (id)')
+    add_column(conn, 'product', 'material_id', 'INTEGER REFERENCES material (id)')
+    add_column(conn, 'product', 'color_id', 'INTEGER REFERENCES color (id)')
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_product_visibility_author_id_date '
+                      'ON product (visibility, author_id, date)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_product_material_id ON product (material_id)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_product_color_id ON product (color_id)'))
+
+    conn.execute(text('DELETE FROM product_image'))
+    caches = {'author': {}, 'material': {}, 'color': {}}
+    rows = conn.execute(text('SELECT id, image, author, material, color FROM product')).fetchall()
+    for id, image, author, material, color in rows:
+        paths = (image or '').split()
+        if paths:
+            conn.execute(text('INSERT INTO product_image (product_id, path, position, is_primary) '
+                              'VALUES (:product_id, :path, :position, :is_primary)'),
+                         [{'product_id': id, 'path': path, 'position': position, 'is_primary': position == 0}
+                          for position, path in enumerate(paths)])
+        conn.execute(text('UPDATE product SET primary_image = :primary_image, author_id = :author_id, '
+                          'material_id = :material_id, color_id = :color_id WHERE id = :id'),
+                     {'id': id,
+                      'primary_image': paths[0] if paths else None,
+                      'author_id': lookup(conn, 'author', author, caches['author']),
+                      'material_id': lookup(conn, 'material', material, caches['material']),
+                      'color_id': lookup(conn, 'color', color, caches['color'])})
+
+
+def order_idempotency_key(conn):
+    add_column(conn, 'order', 'idempotency_key', 'VARCHAR(64)')
+    conn.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ix_order_idempotency_key ON "order" (idempotency_key)'))
+
+
+def postgresql_search_index(conn):
+    # 0001 only built the SQLite FTS5 table; PostgreSQL databases get their GIN index here.
+    search_index.create_index(conn)
+
+
+# Applied in order, each one exactly once per database. upgrade() runs them under a lock,
+# but keep every step safe to re-run in case a database was half-migrated by hand.
+MIGRATIONS = [
+    ('0001_search_table', search_table),
+    ('0002_product_filter_indexes', product_filter_indexes),
+    ('0003_category_table', category_table),
+    ('0004_order_indexes_and_sales', order_indexes_and_sales),
+    ('0005_catalog_version_row', catalog_version_row),
+    ('0006_product_date_index', product_date_index),
+    ('0007_normalized_product_schema', normalized_product_schema),
+    ('0008_order_idempotency_key', order_idempotency_key),
+    ('0009_postgresql_search_index', postgresql_search_index),
+]
+
+
+def applied_migrations(conn):
+    conn.execute(text('CREATE TABLE IF NOT EXISTS %s (name VARCHAR(100) PRIMARY KEY, applied TIMESTAMP)'
+                      % MIGRATIONS_TABLE))
+    return {row[0] for row in conn.execute(text('SELECT name FROM %s' % MIGRATIONS_TABLE))}
+
+
+def status(db):
+    with db.engine.begin() as conn:
+        applied = applied_migrations(conn)
+    return [(name, name in applied) for name, _ in MIGRATIONS]
+
+
+@contextmanager
+def migration_lock(db):
+    """A connection holding a database-wide lock, so workers booting together migrate one at a time.
+
+    PostgreSQL takes an advisory lock. SQLite has none, so everything runs in one BEGIN IMMEDIATE
+    transaction, which holds the write lock until it commits.
+    """
+    conn = db.engine.connect()
+    try:
+        if conn.dialect.name == 'postgresql':
+            conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': LOCK_KEY})
+            try:
+                yield conn
+            finally:
+                conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': LOCK_KEY})
+        elif conn.dialect.name == 'sqlite':
+            # pysqlite only ever opens deferred transactions; take over BEGIN for this connection.
+            driver = conn.connection.connection
+            driver.isolation_level = None
+            try:
+                with conn.begin():
+                    conn.execute(text('BEGIN IMMEDIATE'))
+                    yield conn
+            finally:
+                driver.isolation_level = ''
+        else:
+            yield conn
+    finally:
+        conn.close()
+
+
+def upgrade(db):
+    """Create missing tables, then apply the migrations this database has not seen yet."""
+    with migration_lock(db) as conn:
+        with conn.begin():
+            db.Model.metadata.create_all(bind=conn)
+            applied = applied_migrations(conn)
+
+        for name, migration in MIGRATIONS:
+            if name in applied:
+                continue
+            with conn.begin():
+                migration(conn)
+                conn.execute(text('INSERT INTO %s (name, applied) VALUES (:name, CURRENT_TIMESTAMP)'
+                                  % MIGRATIONS_TABLE), {'name': name})
@@ -0,0 +1,205 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+# orders-<pid>.jsonl, or orders-<pid>.jsonl.<claimer pid>.recovering while another worker replays it.
+JOURNAL_NAME = re.compile(r'^orders-(\d+)\.jsonl(?:\.(\d+)\.recovering)?$')
+# Orders that write_batch rejected for good, kept for a human to look at.
+DEAD_LETTER_NAME = 'dead-letter.jsonl'
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class OrderQueue:
+    """Write-behind order intake.
+
+    enqueue() appends the order to this process's journal (orders-<pid>.jsonl), fsyncs and returns.
+    A background thread hands pending orders to write_batch in groups, one transaction per group,
+    and rewrites the journal down to the still pending orders after every committed group. On start
+    the journal left by a previous process with this pid, or by any dead worker, is replayed;
+    write_batch must skip idempotency keys it has already stored.
+
+    When a group fails, its orders are retried one at a time. An order failing with one of
+    permanent_errors is moved to the dead-letter file so the orders behind it can go through;
+    any other error is taken as the database being unavailable, and the order stays queued.
+    """
+
+    def __init__(self, journal_dir, write_batch, max_pending=1000, batch_size=100, interval=0.2,
+                 permanent_errors=()):
+        self.journal_dir = journal_dir
+        self.write_batch = write_batch
+        self.permanent_errors = tuple(permanent_errors)
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending = deque()
+        self._keys = set()
+        self._condition = threading.Condition()
+        self._journal = None
+        self._thread = None
+        self._orphans = []
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.journal_dir, 'orders-%d.jsonl' % os.getpid())
+
+    @property
+    def dead_letter_path(self):
+        return os.path.join(self.journal_dir, DEAD_LETTER_NAME)
+
+    def start(self):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        recovered = self._recover()
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        for entry in recovered:
+            self._append(entry)
+        self._thread = threading.Thread(target=self._run, name='order-writer', daemon=True)
+        self._thread.start()
+
+    def _recover(self):
+        entries = []
+        for name in sorted(os.listdir(self.journal_dir)):
+            match = JOURNAL_NAME.match(name)
+            if not match:
+                continue
+            owner = int(match.group(2) or match.group(1))
+            if owner != os.getpid() and _process_alive(owner):
+                continue
+            # Claim the journal; rename is atomic, so only one starting worker wins it.
+            path = os.path.join(self.journal_dir, name)
+            claimed = os.path.join(self.journal_dir, 'orders-%s.jsonl.%d.recovering' % (match.group(1), os.getpid()))
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            entries.extend(self._read(claimed))
+            # Deleted by the writer thread, once start() has copied the entries into our own journal.
+            self._orphans.append(claimed)
+        return entries
+
+    @staticmethod
+    def _read(path):
+        entries = []
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # A torn last line from a crash mid-write.
+                    log.warning('Skipping unreadable order journal line in %s', path)
+        return entries
+
+    def _append(self, entry):
+        with self._condition:
+            if entry['idempotency_key'] in self._keys:
+                return False
+            self._journal.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._keys.add(entry['idempotency_key'])
+            self._pending.append(entry)
+            self._condition.notify()
+            return True
+
+    def enqueue(self, entry):
+        """Durably accept an order; raises QueueFull when the writer is too far behind."""
+        if len(self._pending) >= self.max_pending:
+            raise QueueFull()
+        return self._append(entry)
+
+    def _remove_orphans(self):
+        for path in self._orphans:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._orphans = []
+
+    def _write_each(self, batch):
+        """Retry a failed group order by order; return how many of its leading orders are settled."""
+        settled = 0
+        for entry in batch:
+            try:
+                self.write_batch([entry])
+            except self.permanent_errors:
+                log.exception('Order %s rejected, moving it to %s', entry['idempotency_key'], self.dead_letter_path)
+                self._dead_letter(entry)
+            except Exception:
+                log.exception('Could not write order %s, will retry', entry['idempotency_key'])
+                break
+            settled += 1
+        return settled
+
+    def _dead_letter(self, entry):
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _compact(self):
+        """Rewrite the journal to hold only the pending orders; call with the condition held."""
+        if not self._pending:
+            self._journal.truncate(0)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            return
+        tmp = '%s.tmp' % self.journal_path
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for entry in self._pending:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal_path)
+        self._journal.close()
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    def _run(self):
+        self._remove_orphans()
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                batch = [self._pending[i] for i in range(min(self.batch_size, len(self._pending)))]
+
+            try:
+                self.write_batch(batch)
+                settled = len(batch)
+            except Exception:
+                log.exception('Order batch of %d failed, retrying one by one', len(batch))
+                settled = self._write_each(batch)
+
+            if settled:
+                with self._condition:
+                    for entry in batch[:settled]:
+                        self._pending.popleft()
+                        self._keys.discard(entry['idempotency_key'])
+                    self._compact()
+
+            # Let more orders pile up so the next transaction carries a bigger group,
+            # or give the database a moment when nothing went through.
+            time.sleep(self.interval)
+
+    def flush(self, timeout=None):
+        """Block until every accepted order has been written, or the timeout passes."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._pending and (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.05)
+        return not self._pending
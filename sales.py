@@ -0,0 +1,37 @@
+from sqlalchemy import text
+
+
+def month_key(date):
+    return date.strftime('%Y-%m')
+
+
+def record_sale(bind, product_id, date, delta=1):
+    """Add delta to a product's order counter for the month of date."""
+    params = {'product_id': product_id, 'month': month_key(date), 'delta': delta}
+    if delta > 0:
+        # One statement, so two first sales of a month racing each other cannot both try to INSERT.
+        bind.execute(text('INSERT INTO product_sales (product_id, month, count) '
+                          'VALUES (:product_id, :month, :delta) '
+                          'ON CONFLICT (product_id, month) DO UPDATE SET count = product_sales.count + :delta'),
+                     params)
+        return
+    bind.execute(text('UPDATE product_sales SET count = count + :delta '
+                      'WHERE product_id = :product_id AND month = :month'), params)
+    bind.execute(text('DELETE FROM product_sales WHERE product_id = :product_id AND month = :month '
+                      'AND count <= 0'), params)
+
+
+def rebuild_sales(bind):
+    """Recompute every counter from the order table."""
+    counts = {}
+    for product_id, date in bind.execute(text('SELECT product_id, date FROM "order" WHERE date IS NOT NULL')):
+        # SQLite hands back the raw 'YYYY-MM-DD ...' text for a textual query.
+        month = date[:7] if isinstance(date, str) else month_key(date)
+        counts[(product_id, month)] = counts.get((product_id, month), 0) + 1
+
+    bind.execute(text('DELETE FROM product_sales'))
+    if counts:
+        bind.execute(text('INSERT INTO product_sales (product_id, month, count) '
+                          'VALUES (:product_id, :month, :count)'),
+                     [{'product_id': product_id, 'month': month, 'count': count}
+                      for (product_id, month), count in counts.items()])
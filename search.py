@@ -0,0 +1,139 @@
+import re
+from sqlalchemy import bindparam, text
+
+SEARCH_TABLE = 'product_search'
+SEARCH_COLUMNS = ['title', 'desc', 'desc_opt', 'author', 'categories',
+                  'material', 'material_opt', 'color', 'color_opt']
+
+_columns = ', '.join('"%s"' % c for c in SEARCH_COLUMNS)
+_product_columns = ', '.join('coalesce(product."%s", \'\')' % c for c in SEARCH_COLUMNS)
+_params = ', '.join(':%s' % c for c in SEARCH_COLUMNS)
+# PostgreSQL indexes this expression with GIN; queries must spell it exactly the same way to use the index.
+_document = "to_tsvector('simple', %s)" % " || ' ' || ".join('coalesce("%s", \'\')' % c for c in SEARCH_COLUMNS)
+POSTGRESQL_INDEX = 'ix_product_search'
+
+
+def _dialect_name(bind):
+    return (bind.dialect if hasattr(bind, 'dialect') else bind.get_bind().dialect).name
+
+
+def uses_fts(bind):
+    """FTS5 only exists on SQLite; PostgreSQL searches a GIN-indexed tsvector, anything else a LIKE scan."""
+    return _dialect_name(bind) == 'sqlite'
+
+
+def create_index(bind):
+    if _dialect_name(bind) == 'postgresql':
+        # An expression index keeps itself up to date, so the index_product/remove_product calls are no-ops there.
+        bind.execute(text('CREATE INDEX IF NOT EXISTS %s ON product USING gin (%s)' % (POSTGRESQL_INDEX, _document)))
+    if not uses_fts(bind):
+        return
+    bind.execute(text('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, tokenize = "unicode61")'
+                      % (SEARCH_TABLE, _columns)))
+
+
+def rebuild(bind):
+    if not uses_fts(bind):
+        return
+    bind.execute(text('DELETE FROM %s' % SEARCH_TABLE))
+    bind.execute(text('INSERT INTO %s (rowid, %s) SELECT product.id, %s FROM product'
+                      % (SEARCH_TABLE, _columns, _product_columns)))
+
+
+def index_product(bind, product):
+    if not uses_fts(bind):
+        return
+    remove_product(bind, product.id)
+    values = {c: getattr(product, c) or '' for c in SEARCH_COLUMNS}
+    bind.execute(text('INSERT INTO %s (rowid, %s) VALUES (:id, %s)' % (SEARCH_TABLE, _columns, _params)),
+                 dict(values, id=product.id))
+
+
+def remove_product(bind, product_id):
+    if not uses_fts(bind):
+        return
+    bind.execute(text('DELETE FROM %s WHERE rowid = :id' % SEARCH_TABLE), {'id': product_id})
+
+
+def reindex_products(bind, ids):
+    """index_product for many products at once, reading their current values from the product table."""
+    if not uses_fts(bind) or not ids:
+        return
+    remove_products(bind, ids)
+    bind.execute(text('INSERT INTO %s (rowid, %s) SELECT product.id, %s FROM product WHERE product.id IN :ids'
+                      % (SEARCH_TABLE, _columns, _product_columns)).bindparams(bindparam('ids', expanding=True)),
+                 {'ids': list(ids)})
+
+
+def remove_products(bind, ids):
+    if not uses_fts(bind) or not ids:
+        return
+    bind.execute(text('DELETE FROM %s WHERE rowid IN :ids' % SEARCH_TABLE).bindparams(bindparam('ids', expanding=True)),
+                 {'ids': list(ids)})
+
+
+def match_expression(query):
+    """Turn user input into an FTS5 query: every word is a quoted prefix term, all of them required."""
+    terms = re.findall(r'\w+', query.lower())
+    return ' '.join('"%s"*' % term for term in terms)
+
+
+def tsquery_expression(query):
+    """The PostgreSQL counterpart of match_expression: every word a prefix term, all of them required."""
+    terms = re.findall(r'\w+', query.lower())
+    return ' & '.join('%s:*' % term for term in terms)
+
+
+def _tsvector_search(bind, query, page, per_page):
+    expression = tsquery_expression(query)
+    if not expression:
+        return [], 0
+
+    params = {'expression': expression, 'visible': True, 'limit': per_page, 'offset': (page - 1) * per_page}
+    where = "FROM product WHERE %s @@ to_tsquery('simple', :expression) AND product.visibility = :visible" % _document
+
+    total = bind.execute(text('SELECT count(*) ' + where), params).scalar()
+    rows = bind.execute(text("SELECT product.id " + where + " ORDER BY ts_rank(%s, to_tsquery('simple', :expression)) "
+                             "DESC, product.date LIMIT :limit OFFSET :offset" % _document), params).fetchall()
+    return [row[0] for row in rows], total
+
+
+def _like_search(bind, query, page, per_page):
+    terms = re.findall(r'\w+', query.lower())
+    if not terms:
+        return [], 0
+
+    params = {'visible': True, 'limit': per_page, 'offset': (page - 1) * per_page}
+    conditions = []
+    for number, term in enumerate(terms):
+        params['term%d' % number] = '%' + term + '%'
+        conditions.append('(%s)' % ' OR '.join('lower(coalesce(product."%s", \'\')) LIKE :term%d' % (c, number)
+                                               for c in SEARCH_COLUMNS))
+    where = 'FROM product WHERE product.visibility = :visible AND ' + ' AND '.join(conditions)
+
+    total = bind.execute(text('SELECT count(*) ' + where), params).scalar()
+    rows = bind.execute(text('SELECT product.id ' + where + ' ORDER BY product.date LIMIT :limit OFFSET :offset'),
+                        params).fetchall()
+    return [row[0] for row in rows], total
+
+
+def search_products(bind, query, page=1, per_page=12):
+    """Return (ids, total) of visible products matching the query, best matches first."""
+    if _dialect_name(bind) == 'postgresql':
+        return _tsvector_search(bind, query, page, per_page)
+    if not uses_fts(bind):
+        return _like_search(bind, query, page, per_page)
+
+    expression = match_expression(query)
+    if not expression:
+        return [], 0
+
+    where = 'FROM %s JOIN product ON product.id = %s.rowid ' \
+            'WHERE %s MATCH :expression AND product.visibility = :visible' % (SEARCH_TABLE, SEARCH_TABLE, SEARCH_TABLE)
+
+    total = bind.execute(text('SELECT count(*) ' + where), {'expression': expression, 'visible': True}).scalar()
+    rows = bind.execute(text('SELECT product.id ' + where + ' ORDER BY %s.rank, product.date '
+                             'LIMIT :limit OFFSET :offset' % SEARCH_TABLE),
+                        {'expression': expression, 'visible': True,
+                         'limit': per_page, 'offset': (page - 1) * per_page}).fetchall()
+    return [row[0] for row in rows], total